@@ -0,0 +1,827 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Area weighted aggregation of the built-environment variables of the grid
+(500x500 m cells for Geneva) for one or many neighbourhood polygons, without
+any Streamlit dependency.
+
+    >>> from aggregation import aggregate_polygons
+    >>> values = aggregate_polygons(quartiers)   # one row per polygon
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import shapely
+
+from instrumentation import register_gauges, stage
+from result_cache import ResultCache
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+GRID_URL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Data',
+                        'Grid_All_Vars_Geneve_27_11_2023.gpkg')
+BUFFER_DISTANCE = 500
+# Buffer distances of the sensitivity analysis (m)
+BUFFER_DISTANCES = [250, 500, 750, 1000]
+# Max. relative difference of cell areas when the grid is matched to a
+# lattice, and max. difference between the lattice and the polygon overlay
+# weights of a buffer's cells (checked by benchmark.py)
+LATTICE_TOLERANCE = 1e-8
+
+BOUNDARY_INSIDE = 'inside'
+BOUNDARY_PARTLY_OUTSIDE = 'partly_outside'
+BOUNDARY_OUTSIDE = 'outside'
+
+#------------------------------------------------------------------------------
+# 2. Functions
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.1. Canton boundary and containment check
+def boundary_sidecar_path(grid_url):
+    # Canton outline shipped next to the grid, e.g. Grid_..._boundary.gpkg
+    root, _ = os.path.splitext(grid_url)
+    return root + '_boundary.gpkg'
+
+def _load_boundary(grid, grid_url, grid_sha1):
+    # Canton outline from the sidecar layer, either shipped as is or written by
+    # overlays.py from this grid (grid_sha1 column), or union of all grid
+    # cells, prepared for fast predicates
+    sidecar_url = boundary_sidecar_path(grid_url)
+    sidecar = gpd.read_file(sidecar_url) if os.path.exists(sidecar_url) else None
+    if sidecar is not None and ('grid_sha1' not in sidecar.columns
+                                or (sidecar['grid_sha1'] == grid_sha1).all()):
+        boundary = sidecar.to_crs(grid.crs).union_all()
+    else:
+        boundary = grid.union_all()
+    shapely.prepare(boundary)
+    return boundary
+
+def boundary_status(boundary, geoms):
+    # Vectorized containment check: BOUNDARY_INSIDE, BOUNDARY_PARTLY_OUTSIDE
+    # or BOUNDARY_OUTSIDE for every geometry
+    geoms = np.asarray(geoms)
+    return np.where(shapely.contains(boundary, geoms), BOUNDARY_INSIDE,
+                    np.where(shapely.intersects(boundary, geoms),
+                             BOUNDARY_PARTLY_OUTSIDE, BOUNDARY_OUTSIDE))
+
+def drawing_in_boundary(boundary,drawing):
+    return str(boundary_status(boundary, drawing.geometry.values[:1])[0])
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.2. Area weights and weighted aggregates
+def is_numeric_variable(dtype):
+    return dtype in ['float64','int64']
+
+def _variable_matrices(layer, var_names):
+    # Stack the layer's variables once into a cells x variables float matrix
+    # (numeric) and a cells x variables code matrix (categorical, -1 = NaN)
+    num_names = [v for v in var_names if is_numeric_variable(layer.dtypes[v])]
+    cat_names = [v for v in var_names if v not in num_names]
+    
+    cat_codes = np.full((len(layer), len(cat_names)), -1, dtype='int64')
+    cat_labels = []
+    for j, var_name in enumerate(cat_names):
+        codes, labels = pd.factorize(layer[var_name], sort = True)
+        cat_codes[:, j] = codes
+        cat_labels.append(np.asarray(labels, dtype = object))
+    
+    return {'var_names': list(var_names),
+            'num_names': num_names,
+            'num_values': layer[num_names].to_numpy(dtype = 'float64'),
+            'cat_names': cat_names,
+            'cat_codes': cat_codes,
+            'cat_labels': cat_labels}
+
+def _intersection_areas(layer, geoms):
+    # Spatial join of many buffers against the layer's STRtree: returns the
+    # (buffer, feature) pairs and the area of their intersection. Features
+    # fully inside a buffer keep their area as is, only the others are
+    # clipped.
+    layer_geoms = np.asarray(layer.geometry.values)
+    geoms = np.asarray(geoms)
+    groups, rows = layer.sindex.query(geoms, predicate = 'intersects')
+    inside_groups, inside_rows = layer.sindex.query(geoms,
+                                                    predicate = 'contains_properly')
+    inside = np.isin(groups * len(layer) + rows,
+                     inside_groups * len(layer) + inside_rows)
+    
+    areas = shapely.area(layer_geoms[rows])
+    areas[~inside] = shapely.area(shapely.intersection(layer_geoms[rows[~inside]],
+                                                       geoms[groups[~inside]]))
+    
+    keep = areas > 0
+    return groups[keep], rows[keep], areas[keep]
+
+def _intersection_weights(layer, geoms):
+    # (buffer, feature) pairs and the feature's share of the buffer's
+    # intersected area
+    groups, rows, areas = _intersection_areas(layer, geoms)
+    totals = np.bincount(groups, weights = areas, minlength = len(geoms))
+    return groups, rows, areas / totals[groups]
+
+def _weighted_aggregates(matrices, groups, rows, weights, n_groups):
+    # Area weighted mean of every numeric variable and area weighted mode of
+    # every categorical variable for every group in one pass; missing values
+    # weigh zero. Returns one array of n_groups values per variable.
+    var_aggr_dict = {}
+    
+    num_values = matrices['num_values'][rows]
+    n_num = num_values.shape[1]
+    num_present = ~np.isnan(num_values)
+    num_index = (groups[:, None] * n_num + np.arange(n_num)).ravel()
+    num_aggr = np.bincount(
+        num_index,
+        weights = (np.where(num_present, num_values, 0) * weights[:, None]).ravel(),
+        minlength = n_groups * n_num).reshape(n_groups, n_num).astype('float64')
+    num_count = np.bincount(num_index[num_present.ravel()],
+                            minlength = n_groups * n_num).reshape(n_groups, n_num)
+    num_aggr = np.round(num_aggr, 3)
+    num_aggr[num_count == 0] = np.nan
+    var_aggr_dict.update(zip(matrices['num_names'], num_aggr.T))
+    
+    cat_codes = matrices['cat_codes'][rows]
+    n_cat = len(matrices['cat_names'])
+    n_labels = max([len(labels) for labels in matrices['cat_labels']], default = 0)
+    cat_present = cat_codes >= 0
+    # Weights are summed over the (group, variable, label) triples that occur
+    # only: a dense tally would hold n_groups * n_cat * n_labels sums
+    cat_index = ((groups[:, None] * n_cat + np.arange(n_cat)) * n_labels
+                 + cat_codes)[cat_present]
+    cat_keys, cat_inverse = np.unique(cat_index, return_inverse = True)
+    cat_sums = np.bincount(
+        cat_inverse,
+        weights = np.broadcast_to(weights[:, None], cat_codes.shape)[cat_present],
+        minlength = len(cat_keys))
+    cat_keys, cat_sums = cat_keys[cat_sums > 0], cat_sums[cat_sums > 0]
+    # Heaviest label of every (group, variable), the first label on ties
+    cat_slots, cat_modes = np.divmod(cat_keys, max(n_labels, 1))
+    order = np.lexsort((cat_modes, -cat_sums, cat_slots))
+    first = np.diff(cat_slots[order], prepend = -1) != 0
+    cat_groups, cat_vars = np.divmod(cat_slots[order][first], max(n_cat, 1))
+    cat_modes = cat_modes[order][first]
+    for j, var_name in enumerate(matrices['cat_names']):
+        cat_aggr = np.full(n_groups, np.nan, dtype = object)
+        found = cat_vars == j
+        cat_aggr[cat_groups[found]] = matrices['cat_labels'][j][cat_modes[found]]
+        var_aggr_dict[var_name] = cat_aggr
+    
+    return {var_name: var_aggr_dict[var_name] for var_name in matrices['var_names']}
+
+def _plain_means(matrices, groups, rows, n_groups):
+    # Unweighted mean of every numeric variable per group, ignoring NaN
+    num_values = matrices['num_values'][rows]
+    num_present = ~np.isnan(num_values)
+    sums = np.zeros((n_groups, num_values.shape[1]))
+    counts = np.zeros((n_groups, num_values.shape[1]))
+    np.add.at(sums, groups, np.where(num_present, num_values, 0))
+    np.add.at(counts, groups, num_present)
+    with np.errstate(invalid = 'ignore'):
+        return dict(zip(matrices['num_names'], (sums / counts).T))
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.3. Regular lattice fast path: the reference grid is made of square cells
+# (500x500 m, or e.g. 100x100 m), only the cells along the canton border are
+# clipped
+def _cell_size(geoms, bounds):
+    # Side of the unclipped cells: most frequent width of the square cells
+    # filling their bounding box, None if there is none
+    widths = bounds[:, 2] - bounds[:, 0]
+    square = (np.isclose(widths, bounds[:, 3] - bounds[:, 1])
+              & np.isclose(shapely.area(geoms), widths ** 2))
+    if not square.any():
+        return None
+    sizes, counts = np.unique(np.round(widths[square], 6), return_counts = True)
+    return float(sizes[counts.argmax()])
+
+def _detect_lattice(grid, cell_size = None, origin = None):
+    # Find the cell size (if None) and the lattice origin (lower left corner)
+    # from the unclipped cells and give every grid cell its (row, col); None
+    # if the grid is not a lattice
+    geoms = np.asarray(grid.geometry.values)
+    bounds = shapely.bounds(geoms)
+    if cell_size is None:
+        cell_size = _cell_size(geoms, bounds)
+        if cell_size is None:
+            return None
+    full = (np.isclose(bounds[:, 2] - bounds[:, 0], cell_size)
+            & np.isclose(bounds[:, 3] - bounds[:, 1], cell_size)
+            & np.isclose(shapely.area(geoms), cell_size ** 2))
+    if origin is None:
+        if not full.any():
+            return None
+        x0, y0 = bounds[full, 0].min(), bounds[full, 1].min()
+        x0 -= np.ceil((x0 - bounds[:, 0].min()) / cell_size - 1e-9) * cell_size
+        y0 -= np.ceil((y0 - bounds[:, 1].min()) / cell_size - 1e-9) * cell_size
+    else:
+        x0, y0 = origin
+    
+    points = shapely.get_coordinates(shapely.point_on_surface(geoms))
+    cols = np.floor((points[:, 0] - x0) / cell_size).astype('int64')
+    rows = np.floor((points[:, 1] - y0) / cell_size).astype('int64')
+    n_rows, n_cols = rows.max() + 1, cols.max() + 1
+    
+    # Every cell must lie in its own lattice square
+    squares = shapely.box(x0 + cols * cell_size, y0 + rows * cell_size,
+                          x0 + (cols + 1) * cell_size, y0 + (rows + 1) * cell_size)
+    cell_areas = shapely.area(geoms)
+    in_square = shapely.area(shapely.intersection(geoms, squares))
+    if (not np.allclose(in_square, cell_areas, rtol = LATTICE_TOLERANCE, atol = 1e-6)
+            or len(np.unique(rows * n_cols + cols)) != len(grid)):
+        return None
+    full = np.isclose(cell_areas, cell_size ** 2, rtol = LATTICE_TOLERANCE)
+    
+    cell_index = np.full((n_rows, n_cols), -1, dtype = 'int64')
+    cell_index[rows, cols] = np.arange(len(grid))
+    clipped_geoms = np.full((n_rows, n_cols), None, dtype = object)
+    clipped_geoms[rows[~full], cols[~full]] = geoms[~full]
+    
+    return {'origin': (x0, y0),
+            'cell_size': cell_size,
+            'shape': (n_rows, n_cols),
+            'cell_index': cell_index,
+            'clipped_geoms': clipped_geoms}
+
+def _lattice_bands(lattice, matrices):
+    # Dense (rows, cols, variables) bands, NaN / -1 where there is no cell or
+    # no data; the flattened views keep the layout of _variable_matrices
+    n_rows, n_cols = lattice['shape']
+    present = lattice['cell_index'] >= 0
+    num_bands = np.full((n_rows, n_cols, len(matrices['num_names'])), np.nan)
+    num_bands[present] = matrices['num_values'][lattice['cell_index'][present]]
+    cat_bands = np.full((n_rows, n_cols, len(matrices['cat_names'])), -1,
+                        dtype = 'int64')
+    cat_bands[present] = matrices['cat_codes'][lattice['cell_index'][present]]
+    
+    return dict(matrices,
+                num_bands = num_bands,
+                cat_bands = cat_bands,
+                num_values = num_bands.reshape(n_rows * n_cols, -1),
+                cat_codes = cat_bands.reshape(n_rows * n_cols, -1))
+
+def _clamped_mean(ya, yb, lo, hi):
+    # Mean of clamp(y, lo, hi) - lo for y going linearly from ya to yb
+    def primitive(y):
+        inside = np.clip(np.minimum(y, hi) - lo, 0, None)
+        return 0.5 * inside ** 2 + (hi - lo) * np.clip(y - hi, 0, None)
+    
+    dy = yb - ya
+    flat = np.abs(dy) < 1e-9
+    midpoint = np.clip(0.5 * (ya + yb), lo, hi) - lo
+    slope = (primitive(yb) - primitive(ya)) / np.where(flat, 1, dy)
+    return np.where(flat, midpoint, slope)
+
+def _lattice_cell_areas(lattice, geom):
+    # Exact area of geom in every lattice cell of its bounding box, from the
+    # boundary integral  area = -sum over edges of (clamp(y, y0, y1) - y0) dx
+    # taken column by column; returns window rows, cols and areas
+    size = lattice['cell_size']
+    x0, y0 = lattice['origin']
+    n_rows, n_cols = lattice['shape']
+    
+    geom = shapely.orient_polygons(geom)
+    xmin, ymin, xmax, ymax = shapely.bounds(geom)
+    c0 = max(int(np.floor((xmin - x0) / size)), 0)
+    r0 = max(int(np.floor((ymin - y0) / size)), 0)
+    c1 = min(int(np.floor((xmax - x0) / size)), n_cols - 1)
+    r1 = min(int(np.floor((ymax - y0) / size)), n_rows - 1)
+    if c0 > c1 or r0 > r1:
+        return np.empty(0, 'int64'), np.empty(0, 'int64'), np.empty(0)
+    
+    # Edges of all rings, in lattice units relative to the origin
+    rings = shapely.get_rings(shapely.get_parts(geom))
+    coords, ring_index = shapely.get_coordinates(rings, return_index = True)
+    coords = (coords - (x0, y0)) / size
+    same_ring = ring_index[1:] == ring_index[:-1]
+    xa, ya = coords[:-1][same_ring].T
+    xb, yb = coords[1:][same_ring].T
+    keep = xa != xb
+    xa, ya, xb, yb = xa[keep], ya[keep], xb[keep], yb[keep]
+    
+    # Split edges at column boundaries
+    left, right = np.minimum(xa, xb), np.maximum(xa, xb)
+    first_col = np.floor(left).astype('int64')
+    n_pieces = np.floor(right).astype('int64') - first_col + 1
+    edge = np.repeat(np.arange(len(xa)), n_pieces)
+    col = first_col[edge] + np.arange(n_pieces.sum()) - np.repeat(
+        np.cumsum(n_pieces) - n_pieces, n_pieces)
+    seg_left = np.maximum(left[edge], col)
+    seg_right = np.minimum(right[edge], col + 1)
+    in_window = (col >= c0) & (col <= c1) & (seg_right > seg_left)
+    edge, col = edge[in_window], col[in_window]
+    seg_left, seg_right = seg_left[in_window], seg_right[in_window]
+    
+    slope = (yb - ya)[edge] / (xb - xa)[edge]
+    y_left = ya[edge] + slope * (seg_left - xa[edge])
+    y_right = ya[edge] + slope * (seg_right - xa[edge])
+    signed_dx = np.sign(xb - xa)[edge] * (seg_right - seg_left)
+    
+    # Contribution of every piece to every row of the window
+    row_lo = np.arange(r0, r1 + 1)[None, :]
+    contributions = -signed_dx[:, None] * _clamped_mean(
+        y_left[:, None], y_right[:, None], row_lo, row_lo + 1)
+    areas = np.zeros((c1 - c0 + 1, r1 - r0 + 1))
+    np.add.at(areas, col - c0, contributions)
+    
+    rows, cols = np.meshgrid(np.arange(r0, r1 + 1), np.arange(c0, c1 + 1),
+                             indexing = 'ij')
+    return rows.ravel(), cols.ravel(), areas.T.ravel() * size ** 2
+
+def _lattice_intersection_areas(lattice, geom):
+    # Cells of geom (rows indexing the flattened lattice) and their area in
+    # geom; cells clipped by the canton border are intersected exactly
+    rows, cols, areas = _lattice_cell_areas(lattice, geom)
+    exists = lattice['cell_index'][rows, cols] >= 0
+    rows, cols, areas = rows[exists], cols[exists], areas[exists]
+    
+    clipped = lattice['clipped_geoms'][rows, cols]
+    is_clipped = shapely.is_geometry(clipped)
+    if is_clipped.any():
+        areas[is_clipped] = shapely.area(
+            shapely.intersection(clipped[is_clipped], geom))
+    
+    keep = areas > 0
+    return rows[keep] * lattice['shape'][1] + cols[keep], areas[keep]
+
+def _lattice_intersection_weights(lattice, geom):
+    # Same contract as _intersection_weights, with rows indexing the flattened
+    # lattice
+    flat_rows, areas = _lattice_intersection_areas(lattice, geom)
+    return flat_rows, areas / areas.sum()
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.4. Process-wide grid store: the grid and everything derived from it is
+# loaded once per process and shared read-only by all callers
+_grid_stores = {}
+_grid_stores_lock = threading.Lock()
+
+def _file_fingerprint(url):
+    stat = os.stat(url)
+    return (os.path.abspath(url), stat.st_mtime_ns, stat.st_size)
+
+def _file_sha1(url):
+    sha1 = hashlib.sha1()
+    with open(url, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _read_only(arrays):
+    for array in arrays:
+        array.setflags(write = False)
+
+def _load_grid_store(url, fingerprint):
+    load_start = time.perf_counter()
+    
+    grid = gpd.read_file(url)
+    grid.sindex
+    var_names = [c for c in grid.columns if c != 'geometry']
+    matrices = _variable_matrices(grid, var_names)
+    lattice = _detect_lattice(grid)
+    if lattice is not None:
+        lattice['matrices'] = _lattice_bands(lattice, matrices)
+    grid_sha1 = _file_sha1(url)
+    boundary = _load_boundary(grid, url, grid_sha1)
+    
+    _read_only([matrices['num_values'], matrices['cat_codes']]
+               + matrices['cat_labels'])
+    if lattice is not None:
+        _read_only([lattice['cell_index'], lattice['clipped_geoms'],
+                    lattice['matrices']['num_bands'],
+                    lattice['matrices']['cat_bands']])
+    
+    resident_bytes = (grid.drop(columns = 'geometry').memory_usage(deep = True).sum()
+                      + 16 * shapely.get_num_coordinates(grid.geometry.values).sum()
+                      + matrices['num_values'].nbytes + matrices['cat_codes'].nbytes)
+    if lattice is not None:
+        resident_bytes += (lattice['cell_index'].nbytes
+                           + lattice['matrices']['num_bands'].nbytes
+                           + lattice['matrices']['cat_bands'].nbytes)
+    
+    return {'grid': grid,
+            'matrices': matrices,
+            'lattice': lattice,
+            'boundary': boundary,
+            'fingerprint': fingerprint,
+            'sha1': grid_sha1,
+            'load_seconds': time.perf_counter() - load_start,
+            'resident_bytes': int(resident_bytes)}
+
+def _grid_store(url):
+    # The (path, mtime, size) fingerprint is checked on every call, so a new
+    # or modified grid file replaces the stored one
+    fingerprint = _file_fingerprint(url)
+    with _grid_stores_lock:
+        store = _grid_stores.get(fingerprint[0])
+        if store is None or store['fingerprint'] != fingerprint:
+            store = _load_grid_store(url, fingerprint)
+            _grid_stores[fingerprint[0]] = store
+    return store
+
+def fetch_grid_store(url = GRID_URL):
+    # The GeoDataFrame is handed out as a shallow copy: columns and spatial
+    # index are shared, adding or replacing columns does not touch the store
+    store = _grid_store(url)
+    return dict(store, grid = store['grid'].copy(deep = False))
+
+def fetch_data(url = GRID_URL):
+    return fetch_grid_store(url)['grid']
+
+def grid_store_metrics():
+    # Load time and resident size of every grid store loaded by the process
+    with _grid_stores_lock:
+        return {path: {'load_seconds': store['load_seconds'],
+                       'resident_bytes': store['resident_bytes'],
+                       'mtime_ns': store['fingerprint'][1]}
+                for path, store in _grid_stores.items()}
+
+register_gauges('grid_store', 'grid', grid_store_metrics)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.5. Prepared user layers: validated, in the grid CRS, indexed and hashed
+# once, with their aggregates memoized per drawing
+USER_AGGREGATES_CACHE_SIZE = 256
+_user_aggregates = ResultCache(max_entries = USER_AGGREGATES_CACHE_SIZE)
+
+def geometry_fingerprint(geom, decimals = 2):
+    # Hash of the geometry's WKB with coordinates rounded to the centimetre
+    # (grid CRS), so that the same drawing always gets the same fingerprint
+    geom = shapely.transform(geom, lambda coords: np.round(coords, decimals))
+    return hashlib.sha1(shapely.to_wkb(geom)).hexdigest()
+
+def _layer_sha1(layer, column):
+    sha1 = hashlib.sha1(column.encode())
+    sha1.update(pd.util.hash_pandas_object(layer[column], index = False).values)
+    for wkb in shapely.to_wkb(layer.geometry.values):
+        sha1.update(wkb)
+    return sha1.hexdigest()
+
+def prepare_layer(layer, column, crs):
+    # Keep the geometry and column, repair invalid geometries, reproject to
+    # the grid CRS and build the spatial index and the variable matrix
+    layer = layer[[column, layer.geometry.name]]
+    layer = layer[~(layer.geometry.isna() | layer.geometry.is_empty)]
+    invalid = ~layer.geometry.is_valid
+    if invalid.any():
+        layer = layer.copy()
+        layer.loc[invalid, layer.geometry.name] = layer.geometry[invalid].make_valid()
+    if layer.crs is not None:
+        layer = layer.to_crs(crs)
+    else:
+        layer = layer.set_crs(crs)
+    layer = layer.reset_index(drop = True)
+    layer.sindex
+    
+    return {'layer': layer,
+            'column': column,
+            'matrices': _variable_matrices(layer, [column]),
+            'sha1': _layer_sha1(layer, column)}
+
+def prepare_user_layers(user_layers, crs):
+    # user_layers maps a grid variable to a (GeoDataFrame, column) or to an
+    # already prepared layer, which is kept as is
+    return {var_name: (prepare_layer(*user_layer, crs)
+                       if isinstance(user_layer, tuple) else user_layer)
+            for var_name, user_layer in (user_layers or {}).items()}
+
+def _prepared_layer_aggregates(prepared_layer, buffers, record):
+    # Weighted aggregate of the layer's column for every buffer
+    groups, rows, weights = _intersection_weights(prepared_layer['layer'], buffers)
+    record['rows'] = len(rows)
+    return _weighted_aggregates(prepared_layer['matrices'], groups, rows, weights,
+                                len(buffers))[prepared_layer['column']]
+
+def _memoized_layer_aggregates(prepared_layer, buffers, record = None):
+    # Single drawings are memoized per (layer hash, drawing hash), so that a
+    # new drawing or a new layer only recomputes what changed; record (from
+    # instrumentation.stage) gets the rows intersected and the cache hit
+    record = {} if record is None else record
+    if len(buffers) != 1:
+        return _prepared_layer_aggregates(prepared_layer, buffers, record)
+    
+    key = (prepared_layer['sha1'], geometry_fingerprint(buffers[0]))
+    user_aggr = _user_aggregates.get(key)
+    record['cache_hit'] = user_aggr is not None
+    if user_aggr is None:
+        user_aggr = _prepared_layer_aggregates(prepared_layer, buffers, record)
+        _user_aggregates.put(key, user_aggr, int(user_aggr.nbytes))
+    return user_aggr
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.6. Aggregation of buffered polygons
+# Results of single drawings, shared by all sessions
+RESULT_CACHE_MAX_ENTRIES = 1024
+RESULT_CACHE_MAX_BYTES = 64e6
+RESULT_CACHE_TTL_SECONDS = 24 * 3600
+_results = ResultCache(max_entries = RESULT_CACHE_MAX_ENTRIES,
+                       max_bytes = RESULT_CACHE_MAX_BYTES,
+                       ttl_seconds = RESULT_CACHE_TTL_SECONDS)
+
+def _grid_weights(grid_store, buffers):
+    # Grid cells of every buffer with their weights, on the lattice for a
+    # single buffer
+    lattice = grid_store['lattice']
+    if lattice is not None and len(buffers) == 1:
+        rows, weights = _lattice_intersection_weights(lattice, buffers[0])
+        groups = np.zeros(len(rows), dtype = 'int64')
+        return lattice['matrices'], groups, rows, weights
+    groups, rows, weights = _intersection_weights(grid_store['grid'], buffers)
+    return grid_store['matrices'], groups, rows, weights
+
+def _aggregate_buffers(grid_store, buffers, user_layers = None, var_names = None,
+                       on_variable = None, run = None):
+    # Aggregated grid variables (all, or only var_names) for every buffer (in
+    # the grid CRS); variables listed in user_layers ({var_name: prepared
+    # layer}) are taken from the user's layer instead. on_variable(var_name)
+    # is called as soon as a variable is computed. The stages are measured
+    # in run (instrumentation.new_run), if any.
+    buffers = np.asarray(buffers)
+    n_groups = len(buffers)
+    user_layers = user_layers or {}
+    if var_names is None:
+        var_names = grid_store['matrices']['var_names']
+    
+    # The grid is only intersected when one of the variables needs it
+    grid_weights = []
+    def _grid_pass():
+        if not grid_weights:
+            with stage(run, 'grid_overlay') as record:
+                grid_weights.extend(_grid_weights(grid_store, buffers))
+                record['rows'] = len(grid_weights[1])
+        return grid_weights
+    
+    var_aggr_dict = {}
+    grid_var_names = [v for v in var_names if v not in user_layers]
+    if grid_var_names:
+        matrices, groups, rows, weights = _grid_pass()
+        with stage(run, 'grid_aggregates') as record:
+            grid_aggr = _weighted_aggregates(matrices, groups, rows, weights, n_groups)
+            record['rows'] = len(rows)
+        for var_name in grid_var_names:
+            var_aggr_dict[var_name] = grid_aggr[var_name]
+            if on_variable is not None:
+                on_variable(var_name)
+    
+    for var_name in [v for v in var_names if v in user_layers]:
+        with stage(run, f'user_layer:{var_name}') as record:
+            user_aggr = _memoized_layer_aggregates(user_layers[var_name], buffers,
+                                                   record)
+    
+        # No user data in the buffer: fall back on the grid's plain mean
+        if (var_name in grid_store['matrices']['num_names']
+                and pd.isna(user_aggr).any()):
+            matrices, groups, rows, _ = _grid_pass()
+            user_aggr = np.where(pd.isna(user_aggr),
+                                 _plain_means(matrices, groups, rows,
+                                              n_groups)[var_name],
+                                 user_aggr)
+        var_aggr_dict[var_name] = user_aggr
+        if on_variable is not None:
+            on_variable(var_name)
+    
+    return {var_name: var_aggr_dict[var_name] for var_name in var_names}
+
+def update_aggregates(grid_store, drawing, user_layers = None, previous = None,
+                      buffer_distance = BUFFER_DISTANCE, on_progress = None,
+                      run = None):
+    """
+    Aggregated values of a single drawing (GeoDataFrame in the grid CRS) as
+    in the web app, with user layers from prepare_layer.
+    
+    Every variable depends on the grid, the buffered drawing and its user
+    layer, if any. Given the state returned by a previous call, only the
+    variables whose dependencies changed are recomputed. on_progress(done,
+    total, var_name) is called after every variable. Whole results are also
+    cached server-wide per grid, buffered drawing (rounded coordinates) and
+    user layers. The stages are measured in run (instrumentation.new_run),
+    if any.
+    
+    Returns the new state: 'drawing_buffer', 'values_df' (two column table),
+    'values', 'dependencies' and 'recomputed' (variables computed by this
+    call).
+    """
+    user_layers = user_layers or {}
+    var_names = grid_store['matrices']['var_names']
+    with stage(run, 'buffer'):
+        buffer_geom = shapely.buffer(drawing.geometry.values[0], buffer_distance,
+                                     quad_segs = 16)
+        buffer_fingerprint = geometry_fingerprint(buffer_geom)
+    dependencies = {var_name: (grid_store['sha1'], buffer_fingerprint, var_name,
+                               user_layers[var_name]['sha1']
+                               if var_name in user_layers else None)
+                    for var_name in var_names}
+    key = (grid_store['sha1'], buffer_fingerprint,
+           tuple(sorted((var_name, prepared_layer['sha1'])
+                        for var_name, prepared_layer in user_layers.items())))
+    with stage(run, 'result_cache') as record:
+        state = _results.get(key)
+        record['cache_hit'] = state is not None
+    
+    if state is None:
+        previous = previous or {'dependencies': {}, 'values': {}}
+        stale = [var_name for var_name in var_names
+                 if previous['dependencies'].get(var_name) != dependencies[var_name]]
+    
+        n_done = [len(var_names) - len(stale)]
+        def _on_variable(var_name):
+            n_done[0] += 1
+            if on_progress is not None:
+                on_progress(n_done[0], len(var_names), var_name)
+    
+        var_aggr_dict = _aggregate_buffers(grid_store, [buffer_geom], user_layers,
+                                           stale, _on_variable, run)
+        values = {var_name: var_aggr_dict[var_name][0] if var_name in var_aggr_dict
+                  else previous['values'][var_name]
+                  for var_name in var_names}
+    
+        var_aggr_df = pd.DataFrame.from_dict(values, orient = 'index').reset_index()
+        var_aggr_df = var_aggr_df.round(3)
+        drawing_buffer = gpd.GeoDataFrame(index = [0], crs = grid_store['grid'].crs,
+                                          geometry = [buffer_geom])
+    
+        state = {'drawing_buffer': drawing_buffer,
+                 'values_df': var_aggr_df,
+                 'values': values,
+                 'dependencies': dependencies,
+                 'recomputed': stale}
+        _results.put(key, state,
+                     int(var_aggr_df.memory_usage(deep = True).sum()
+                         + 16 * shapely.get_num_coordinates(buffer_geom)))
+    else:
+        state = dict(state, recomputed = [])
+        if on_progress is not None:
+            on_progress(len(var_names), len(var_names), None)
+    
+    return dict(state,
+                drawing_buffer = state['drawing_buffer'].copy(),
+                values_df = state['values_df'].copy())
+
+def aggregate_drawing(grid_store, drawing, user_layers = None,
+                      buffer_distance = BUFFER_DISTANCE):
+    # Buffered drawing and aggregated values, see update_aggregates
+    state = update_aggregates(grid_store, drawing, user_layers,
+                              buffer_distance = buffer_distance)
+    return state['drawing_buffer'], state['values_df']
+
+def result_cache_stats():
+    return {'results': _results.stats(),
+            'user_layers': _user_aggregates.stats()}
+
+register_gauges('cache', 'cache', result_cache_stats)
+
+def clear_caches(grids = True):
+    # Forget all cached aggregates and, unless grids is False, the loaded
+    # grids (benchmarks)
+    if grids:
+        with _grid_stores_lock:
+            _grid_stores.clear()
+    _results.clear()
+    _user_aggregates.clear()
+
+def aggregate_polygons(polygons, grid_url = GRID_URL,
+                       buffer_distance = BUFFER_DISTANCE, user_layers = None):
+    """
+    Aggregated grid variables for many neighbourhood polygons at once.
+    
+    polygons: GeoDataFrame or GeoSeries with a CRS; user_layers optionally
+    maps a grid variable to a (GeoDataFrame, column) replacing it, or to the
+    layer already prepared by prepare_user_layers (to prepare it only once
+    for many calls). Returns one
+    row per polygon (same index) with the polygon's position relative to the
+    canton ('boundary_status') and one column per grid variable. Like in the
+    web app, polygons that are not fully inside the canton get no values.
+    """
+    grid_store = fetch_grid_store(grid_url)
+    crs = grid_store['grid'].crs
+    geoms = polygons.geometry.to_crs(crs)
+    user_layers = prepare_user_layers(user_layers, crs)
+    
+    status = boundary_status(grid_store['boundary'], geoms.values)
+    inside = status == BOUNDARY_INSIDE
+    var_aggr_dict = _aggregate_buffers(grid_store,
+                                       geoms[inside].buffer(buffer_distance).values,
+                                       user_layers)
+    
+    var_aggr_df = pd.DataFrame({'boundary_status': status}, index = polygons.index)
+    for var_name, values in var_aggr_dict.items():
+        column = np.full(len(polygons), np.nan, dtype = values.dtype)
+        column[inside] = values
+        var_aggr_df[var_name] = column
+    return var_aggr_df.round(3)
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 2.7. Several buffer distances and data sources in one pass: the nested
+# buffers are cut into rings, every cell is intersected with the rings it
+# overlaps only, and the ring areas are summed into every larger buffer
+def _ring_areas(layer, rings, lattice = None):
+    # (ring, row, area) of the layer's features (or lattice cells) in every ring
+    if lattice is None:
+        return _intersection_areas(layer, rings)
+    ring_rows, ring_areas = zip(*[_lattice_intersection_areas(lattice, ring)
+                                  for ring in rings])
+    groups = np.repeat(np.arange(len(rings)), [len(rows) for rows in ring_rows])
+    return groups, np.concatenate(ring_rows), np.concatenate(ring_areas)
+
+def _cumulative_weights(groups, rows, areas, n_rows, n_buffers):
+    # Ring j belongs to buffers j to n_buffers - 1: unique (buffer, row) pairs
+    # with their summed area, as shares of every buffer's intersected area
+    n_repeats = n_buffers - groups
+    buffers = (np.repeat(groups, n_repeats) + np.arange(n_repeats.sum())
+               - np.repeat(np.cumsum(n_repeats) - n_repeats, n_repeats))
+    pairs, inverse = np.unique(buffers * n_rows + np.repeat(rows, n_repeats),
+                               return_inverse = True)
+    pair_areas = np.bincount(inverse, weights = np.repeat(areas, n_repeats))
+    groups, rows = pairs // n_rows, pairs % n_rows
+    totals = np.bincount(groups, weights = pair_areas, minlength = n_buffers)
+    return groups, rows, pair_areas / totals[groups]
+
+def aggregate_scenarios(grid_store, drawing, buffer_distances = BUFFER_DISTANCES,
+                        scenarios = None, on_progress = None, run = None):
+    """
+    Aggregated values of a single drawing (GeoDataFrame in the grid CRS) for
+    several buffer distances and data sources at once.
+    
+    scenarios maps a scenario name to its user layers ({var_name: prepared
+    layer}, empty for the grid only; default: {'grid': {}}). The grid and
+    every user layer are intersected once for all distances and scenarios.
+    on_progress(done, total, name) is called after the grid and every layer.
+    Returns a table with one row per variable and one column per (scenario,
+    buffer distance).
+    """
+    scenarios = scenarios if scenarios is not None else {'grid': {}}
+    distances = sorted(set(buffer_distances))
+    n_buffers = len(distances)
+    var_names = grid_store['matrices']['var_names']
+    layers = {}  # sha1 -> (prepared layer, variables it replaces)
+    for user_layers in scenarios.values():
+        for var_name, prepared_layer in user_layers.items():
+            layer_vars = layers.setdefault(prepared_layer['sha1'],
+                                           (prepared_layer, set()))[1]
+            layer_vars.add(var_name)
+    n_steps = 1 + len(layers)
+    
+    with stage(run, 'buffer'):
+        buffers = shapely.buffer(drawing.geometry.values[0], distances,
+                                 quad_segs = 16)
+        rings = np.concatenate([buffers[:1],
+                                shapely.difference(buffers[1:], buffers[:-1])])
+    
+    lattice = grid_store['lattice']
+    with stage(run, 'grid_overlay') as record:
+        if lattice is not None:
+            matrices = lattice['matrices']
+            n_rows = lattice['shape'][0] * lattice['shape'][1]
+        else:
+            matrices, n_rows = grid_store['matrices'], len(grid_store['grid'])
+        groups, rows, weights = _cumulative_weights(
+            *_ring_areas(grid_store['grid'], rings, lattice), n_rows, n_buffers)
+        record['rows'] = len(rows)
+    grid_aggr = _weighted_aggregates(matrices, groups, rows, weights, n_buffers)
+    plain_means = _plain_means(matrices, groups, rows, n_buffers)
+    if on_progress is not None:
+        on_progress(1, n_steps, None)
+    
+    layer_aggr = {}
+    for sha1, (prepared_layer, layer_vars) in layers.items():
+        with stage(run, f"user_layer:{','.join(sorted(layer_vars))}") as record:
+            layer_groups, layer_rows, layer_weights = _cumulative_weights(
+                *_ring_areas(prepared_layer['layer'], rings),
+                len(prepared_layer['layer']), n_buffers)
+            layer_aggr[sha1] = _weighted_aggregates(
+                prepared_layer['matrices'], layer_groups, layer_rows,
+                layer_weights, n_buffers)[prepared_layer['column']]
+            record['rows'] = len(layer_rows)
+        if on_progress is not None:
+            on_progress(1 + len(layer_aggr), n_steps, min(layer_vars))
+    
+    # Same rules as _aggregate_buffers: no user data in the buffer falls back
+    # on the grid's plain mean
+    columns = {}
+    for scenario, user_layers in scenarios.items():
+        values = {}
+        for var_name in var_names:
+            if var_name not in user_layers:
+                values[var_name] = grid_aggr[var_name]
+                continue
+            user_aggr = layer_aggr[user_layers[var_name]['sha1']]
+            if var_name in plain_means and pd.isna(user_aggr).any():
+                user_aggr = np.where(pd.isna(user_aggr), plain_means[var_name],
+                                     user_aggr)
+            values[var_name] = user_aggr
+        # Only numbers are rounded: an uploaded layer can replace a numeric
+        # grid variable by a categorical column
+        for k, distance in enumerate(distances):
+            columns[(scenario, distance)] = [
+                round(float(value), 3) if isinstance(value, (float, np.floating))
+                else value
+                for value in (values[var_name][k] for var_name in var_names)]
+    
+    return pd.DataFrame(columns, index = pd.Index(var_names),
+                        columns = pd.MultiIndex.from_tuples(
+                            columns, names = ['scenario', 'buffer_distance']))
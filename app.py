@@ -7,6 +7,7 @@ Created on Mon Nov 20 12:19:11 2023
 """
 #------------------------------------------------------------------------------
 # 0. Import packages
+import os
 from typing import List
 
 import folium
@@ -19,9 +20,20 @@ import geopandas as gpd
 
 from shapely.geometry import Polygon
 
-import datetime
-
-from io import BytesIO
+from aggregation import (BOUNDARY_INSIDE, BOUNDARY_PARTLY_OUTSIDE,
+                         BUFFER_DISTANCE, BUFFER_DISTANCES, aggregate_scenarios,
+                         drawing_in_boundary, fetch_grid_store,
+                         geometry_fingerprint, prepare_layer, update_aggregates)
+from user_layers import (MemoryBudgetExceeded, layer_nbytes, read_layer_column,
+                         read_layer_info)
+from overlays import GridOverlay, load_overlay_meta
+from perimeters import fetch_perimeters, lookup_perimeter
+from export import EXPORT_FORMATS, export_results, result_hash
+from instrumentation import (finish_run, gauge_values, new_run, record_error,
+                             stage)
+from jobs import (JOB_CANCELLED, JOB_FAILED, JOB_POLL_SECONDS, JOB_QUEUED,
+                  JOB_RUNNING, ServerBusy, cancel_job, job_result, job_status,
+                  submit_job)
 
 import warnings
 warnings.filterwarnings("ignore", "is_categorical_dtype")
@@ -52,6 +64,13 @@ def _show_map(center: List[float], zoom: int) -> folium.Map:
         },
     ).add_to(m)
     return m
+
+def _add_grid_overlay(m: folium.Map, grid_url, labels) -> None:
+    # Grid variables and canton boundary, pre-built by overlays.py and loaded
+    # by the browser; nothing is added if they are missing or outdated
+    meta = load_overlay_meta(fetch_grid_store(grid_url)['sha1'])
+    if meta is not None:
+        GridOverlay(meta, labels).add_to(m)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # 1.2. User drawing to geodataframe
 def _drawing_to_gdf(output):
@@ -63,109 +82,213 @@ def _drawing_to_gdf(output):
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # 1.3. Check if drawing in area and compute average
-def drawing_in_boundary(grid,drawing):
-    grid_limits = grid.dissolve()
-    if grid_limits.contains(drawing.geometry)[0]:
-        return True
-
-@st.cache_data(show_spinner = False)
-def fetch_data(url):
-    data = gpd.read_file(url)
-    return data
-    
-def _compute_avg(grid,drawing,progress_bar):
+def _compute_avg(grid_store,drawing,run=None,buffer_distance=BUFFER_DISTANCE):
     if drawing.geometry is None:
         st.sidebar.warning("⛔️  Dessinez d'abord un polygone sur la carte !")
     
-    # Intersect gridded data with user drawing
-    drawing_buffer = gpd.GeoDataFrame(index = [0], crs = grid.crs,
-                                      geometry = drawing.buffer(500))
-    intersection = gpd.overlay(grid, drawing_buffer, how='intersection')
-    intersection['intersection_area'] = intersection.area
-    intersection['percent_area']=intersection['intersection_area']/intersection['intersection_area'].sum()
-    
-    # Initialize dict in which aggregated value will be stored
-    var_aggr_dict = {}
-    i = 0
-    var_names = list(grid.columns)
-    var_names.remove('geometry')
-    
-    for var_name in var_names:
-        i =+ 1 # for progress bar
-        
-        # Copy intersection to drop values where variable == 0
-        df_calc_i = intersection[[var_name,'percent_area']].copy()
-        df_calc_i.dropna(inplace=True)
-        dtype_calc_i = intersection.dtypes[var_name]
-        
-        # If user has uploaded geopackage for this layer: compute weighed avg with user data
-        if st.session_state[f'{var_name}_uploaded']:
-            user_layer_clipped = st.session_state[f'{var_name}_df'][['geometry',
-                                                              st.session_state[f'{var_name}_selected_colname']]]
-            user_layer_clipped = user_layer_clipped.rename(columns = {st.session_state[f'{var_name}_selected_colname']:var_name})
-            intersection_user_layer = gpd.overlay(user_layer_clipped,
-                                                  drawing_buffer,
-                                                  how = 'intersection')
-            intersection_user_layer['intersection_area'] = intersection_user_layer.area
-            intersection_user_layer['percent_area'] = intersection_user_layer['intersection_area'] / intersection_user_layer['intersection_area'].sum()
-            
-            df_calc_i = intersection_user_layer[[var_name,'percent_area']].copy()
-            df_calc_i.dropna(inplace=True)
-            
-            dtype_calc_i = intersection_user_layer.dtypes[var_name]
-        
-        # Calculate area weighed average
-        if len(df_calc_i) > 0: 
-            if dtype_calc_i in ['float64','int64']:
-                var_i_area_w = df_calc_i[var_name] * df_calc_i['percent_area']
-                var_aggr_dict[var_name] = round(var_i_area_w.sum(),3)
-            else:
-                grouped = df_calc_i.groupby([var_name]).sum()
-                var_aggr_dict[var_name] = grouped.idxmax().iloc[0]
-            
-        else:
-            var_aggr_dict[var_name] = intersection[var_name].mean()
-        
-        # Update progress bar
-        progress_bar.progress(55+ i,text = "Calcul en cours de la valeur agrégée" 
-                              " des variables territoriales...")
-    
-    # Make dataframe from dictionary in which aggregated values are stored
-    var_aggr_df = pd.DataFrame.from_dict(var_aggr_dict, orient = 'index').reset_index()
-    var_aggr_df = var_aggr_df.round(3)
+    # Intersect gridded data with user drawing in the worker pool; only the
+    # variables whose drawing, grid or uploaded layer changed since the last
+    # run are computed
+    _submit_calculation('aggregation', run, update_aggregates, grid_store,
+                        drawing, _session_user_layers(grid_store),
+                        previous = st.session_state.get('aggregation_state'),
+                        buffer_distance = buffer_distance)
+
+def _compute_scenarios(grid_store,drawing,run=None):
+    # Every selected buffer distance, with the uploaded layers and, to compare,
+    # with the grid only
+    user_layers = _session_user_layers(grid_store)
+    if not user_layers:
+        scenarios = {'Grille': {}}
+    elif st.session_state.scenario_compare:
+        scenarios = {'Grille': {}, 'Vos données': user_layers}
+    else:
+        scenarios = {'Vos données': user_layers}
+    _submit_calculation('scenarios', run, aggregate_scenarios, grid_store,
+                        drawing, st.session_state.scenario_distances, scenarios)
+
+def _session_user_layers(grid_store):
+    # If user has uploaded geopackage for a layer: compute weighed avg with user data
+    return {var_name: st.session_state[f'{var_name}_df']
+            for var_name in grid_store['matrices']['var_names']
+            if st.session_state[f'{var_name}_uploaded']
+            and st.session_state[f'{var_name}_df'] is not None}
     
+def _supersede_calculation():
+    # Cancel the running calculation and close its run here, as its job is
+    # dropped before it could be collected
+    previous_job = st.session_state.get('calculation_job')
+    if previous_job is not None:
+        cancel_job(previous_job)
+        finish_run(previous_job['run'], JOB_CANCELLED)
+        st.session_state.calculation_job = None
+
+def _submit_calculation(kind, run, function, *args, **kwargs):
+    # A new calculation supersedes the running one
+    _supersede_calculation()
+    try:
+        job = submit_job(function, *args, run = run, **kwargs)
+    except ServerBusy:
+        st.sidebar.warning("Le serveur est très sollicité, veuillez relancer "
+                           "le calcul dans quelques instants.")
+        finish_run(run, 'busy')
+        return
     
-    st.sidebar.success("Valeurs agrégées calculées !")
+    job['kind'] = kind
+    job['run'] = run
+    st.session_state.calculation_job = job
+
+def _cancel_calculation():
+    if st.session_state.get('calculation_job') is not None:
+        cancel_job(st.session_state.calculation_job)
+
+def _collect_calculation():
+    # Save the results of the session's finished calculation in session state
+    job = st.session_state.get('calculation_job')
+    if job is None or job_status(job) in [JOB_QUEUED, JOB_RUNNING]:
+        return
+    st.session_state.calculation_job = None
     
-    # Save results in session state
-    st.session_state.aggregated_values = True
-    st.session_state.aggregated_values_df = var_aggr_df
-    st.session_state.drawing_buffer = drawing_buffer
+    status = job_status(job)
+    if status == JOB_CANCELLED:
+        st.sidebar.info("Calcul annulé.")
+        finish_run(job['run'], status)
+    elif status == JOB_FAILED:
+        st.sidebar.error("Le calcul a échoué, veuillez réessayer.")
+        record_error(job['run'], job['future'].exception())
+        finish_run(job['run'], status)
+    elif job['kind'] == 'scenarios':
+        st.sidebar.success("Scénarios calculés !")
+        st.session_state.scenario_values_df = _scenario_table(job_result(job))
+        finish_run(job['run'], 'ok')
+    else:
+        aggregation_state = job_result(job)
+        st.sidebar.success("Valeurs agrégées calculées !")
+        st.session_state.aggregation_state = aggregation_state
+        st.session_state.aggregated_values = True
+        st.session_state.aggregated_values_df = aggregation_state['values_df']
+        st.session_state.drawing_buffer = aggregation_state['drawing_buffer']
+
+def _scenario_table(values):
+    # One column per buffer distance (and scenario, if there are several)
+    scenarios = values.columns.get_level_values('scenario')
+    values.columns = [f'{distance:g} m' if scenarios.nunique() == 1
+                      else f'{scenario}, {distance:g} m'
+                      for scenario, distance in values.columns]
+    values.index = [dict_colnames.get(var_name, var_name)
+                    for var_name in values.index]
+    return values.rename_axis('Variables territoriales').reset_index()
+
+@st.fragment(run_every = JOB_POLL_SECONDS)
+def _show_calculation_progress():
+    # Polls the running calculation; the whole page is rerun once it is over
+    job = st.session_state.get('calculation_job')
+    if job is None:
+        return
+    status = job_status(job)
+    if status not in [JOB_QUEUED, JOB_RUNNING]:
+        st.rerun()
+    if job['cancel_event'].is_set():
+        text = "Annulation du calcul..."
+    elif status == JOB_QUEUED:
+        text = "En attente d'un calcul libre sur le serveur..."
+    else:
+        text = ("Calcul en cours de la valeur agrégée des variables "
+                "territoriales...")
+    st.progress(55 + int(45 * job['progress']), text = text)
+    st.button('Annuler le calcul', on_click = _cancel_calculation,
+              disabled = job['cancel_event'].is_set())
 
 
-def _check_area_and_compute_avg(geo_drawing,grid_url, progress_bar: st.progress) -> None: 
+def _check_area_and_compute_avg(geo_drawing,grid_url, progress_bar: st.progress,
+                                scenarios = False) -> None: 
     progress_bar.progress(0,text = 'Télécharger variables territoriales...')
     progress_bar.progress(10,text = 'Télécharger variables territoriales...')
     
-    grid_data = fetch_data(grid_url)
+    # Every stage of the calculation is measured; the run is finished (logged)
+    # when its results are displayed, or earlier if there are none (an export
+    # has its own run, see _export_data)
+    run = new_run(user_layers = [k for k in dict_colnames
+                                 if st.session_state.get(f'{k}_df') is not None])
+    st.session_state.last_run = run
+    
+    with stage(run, 'fetch_grid') as record:
+        grid_store = fetch_grid_store(grid_url)
+        grid_data = grid_store['grid']
+        record['rows'] = len(grid_data)
     
     progress_bar.progress(50,text = 'Télécharger variables territoriales...')
     
     crs = grid_data.crs
-    geo_drawing = geo_drawing.to_crs(crs)
+    with stage(run, 'to_crs'):
+        geo_drawing = geo_drawing.to_crs(crs)
     
     progress_bar.progress(55,text = 'Télécharger variables territoriales...')
     
     
-    if not drawing_in_boundary(grid_data,geo_drawing):
-        st.sidebar.warning(
-            "Le polygone dessiné n'est pas situé dans le Canton de Genève, "
-            "veuillez vous assurer que cela est le cas.") 
+    with stage(run, 'boundary_check'):
+        boundary_status = drawing_in_boundary(grid_store['boundary'],geo_drawing)
+    
+    if boundary_status != BOUNDARY_INSIDE:
+        if boundary_status == BOUNDARY_PARTLY_OUTSIDE:
+            st.sidebar.warning(
+                "Le polygone dessiné dépasse en partie les limites du Canton "
+                "de Genève, veuillez vous assurer qu'il y soit entièrement "
+                "situé.")
+        else:
+            st.sidebar.warning(
+                "Le polygone dessiné n'est pas situé dans le Canton de Genève, "
+                "veuillez vous assurer que cela est le cas.") 
         if st.session_state.aggregated_values:
             st.session_state.aggregated_values_df = pd.DataFrame()
+        finish_run(run, boundary_status)
         
+    elif scenarios:
+        _compute_scenarios(grid_store, geo_drawing, run)
+    else:
+        _compute_avg(grid_store, geo_drawing, run)
+
+def _compute_perimeter(grid_url) -> None:
+    # Precomputed values of the selected official perimeter, looked up by key;
+    # computed like a drawing if the user uploaded layers
+    source, perimeter_id = st.session_state.selected_perimeter
+    run = new_run(perimeter = f'{source}:{perimeter_id}',
+                  user_layers = [k for k in dict_colnames
+                                 if st.session_state.get(f'{k}_df') is not None])
+    st.session_state.last_run = run
+    
+    grid_store = fetch_grid_store(grid_url)
+    with stage(run, 'perimeter_lookup'):
+        perimeter = lookup_perimeter(source, perimeter_id, grid_url)
+    if perimeter is None:
+        # e.g. removed from its layer since the table was rebuilt
+        st.sidebar.warning("Ce périmètre n'est plus disponible, veuillez en "
+                           "choisir un autre.")
+        finish_run(run, 'not_found')
+        return
+    # Same buffer distance as the precomputed values
+    buffer_distance = perimeter['buffer_distance']
+    drawing = gpd.GeoDataFrame(index = [0], crs = grid_store['grid'].crs,
+                               geometry = [perimeter['geometry']])
+    
+    if perimeter['boundary_status'] != BOUNDARY_INSIDE:
+        st.sidebar.warning(f"Le périmètre {perimeter['name']} n'est pas "
+                           "entièrement situé dans le Canton de Genève.")
+        if st.session_state.aggregated_values:
+            st.session_state.aggregated_values_df = pd.DataFrame()
+        finish_run(run, perimeter['boundary_status'])
+    elif _session_user_layers(grid_store):
+        _compute_avg(grid_store, drawing, run, buffer_distance)
     else:
-        _compute_avg(grid_data, geo_drawing, progress_bar)
+        # The precomputed values supersede the running calculation
+        _supersede_calculation()
+        st.sidebar.success("Valeurs agrégées calculées !")
+        st.session_state.aggregated_values = True
+        st.session_state.aggregated_values_df = pd.DataFrame.from_dict(
+            perimeter['values'], orient = 'index').reset_index()
+        st.session_state.drawing_buffer = gpd.GeoDataFrame(
+            index = [0], crs = grid_store['grid'].crs,
+            geometry = drawing.buffer(buffer_distance).values)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # 1.4. Upload geopackage of new layer    
@@ -174,11 +297,15 @@ def _set_clicked_uploader(k):
     st.session_state[f'{k}_uploaded'] = True
 
     if st.session_state[f'{k}_uploaded'] and st.session_state[f'{k}_uploaded_file'] is not None:
-        st.session_state[f'{k}_df'] = gpd.read_file(st.session_state[f'{k}_uploaded_file'])
+        # Only the layer's metadata is read here, the features are streamed
+        # once the column is known (see _load_uploaded_column)
+        layer_info = read_layer_info(st.session_state[f'{k}_uploaded_file'])
+        st.session_state[f'{k}_df'] = None
+        st.session_state[f'{k}_df_colname'] = None
+        st.session_state[f'{k}_nbytes'] = 0
+        st.session_state[f'{k}_error'] = None
         st.session_state[f'{k}_filename'] = st.session_state[f'{k}_uploaded_file'].name
-        st.session_state[f'{k}_colnames'] = list(st.session_state[f'{k}_df'].columns)
-        if 'geometry' in st.session_state[f'{k}_colnames']:
-            st.session_state[f'{k}_colnames'].remove('geometry')
+        st.session_state[f'{k}_colnames'] = layer_info['columns']
         
     elif st.session_state[f'{k}_uploaded'] and st.session_state[f'{k}_uploaded_file'] is None:
         _remove_uploaded_layer(k)
@@ -187,18 +314,80 @@ def _remove_uploaded_layer(k):
     st.session_state[f'{k}_uploaded'] = False
     st.session_state[f'{k}_filename'] = ''
     st.session_state[f'{k}_df'] = None
+    st.session_state[f'{k}_df_colname'] = None
+    st.session_state[f'{k}_nbytes'] = 0
+    st.session_state[f'{k}_error'] = None
     st.session_state[f'{k}_colnames'] = ['','']
 
+def _load_uploaded_column(k, grid_url):
+    # Stream the geometry and the selected column of the features within
+    # reach of a quartier (canton extent + buffer), within what is left of
+    # the session's memory budget
+    colname = st.session_state[f'{k}_selected_colname']
+    grid_store = fetch_grid_store(grid_url)
+    xmin, ymin, xmax, ymax = grid_store['boundary'].bounds
+    extent = (xmin - BUFFER_DISTANCE, ymin - BUFFER_DISTANCE,
+              xmax + BUFFER_DISTANCE, ymax + BUFFER_DISTANCE)
+    used_bytes = sum(st.session_state.get(f'{var_name}_nbytes', 0)
+                     for var_name in dict_colnames if var_name != k)
+    budget_bytes = SESSION_MEMORY_BUDGET_MB * 1e6 - used_bytes
+    
+    st.session_state[f'{k}_df'] = None
+    st.session_state[f'{k}_nbytes'] = 0
+    st.session_state[f'{k}_df_colname'] = colname
+    try:
+        user_layer = read_layer_column(st.session_state[f'{k}_uploaded_file'],
+                                       colname, extent, grid_store['grid'].crs,
+                                       budget_bytes)
+    except MemoryBudgetExceeded:
+        st.session_state[f'{k}_error'] = (
+            f"⛔️  Le document {st.session_state[f'{k}_filename']} dépasse la "
+            f"mémoire disponible pour votre session ({SESSION_MEMORY_BUDGET_MB:.0f} Mo "
+            f"au total, dont {used_bytes / 1e6:.0f} Mo déjà utilisés par vos "
+            "autres documents). Veuillez réduire la couche (moins d'entités "
+            "ou géométries simplifiées) ou enlever d'autres documents.")
+        return
+    
+    # Validated, reprojected and indexed once per upload
+    st.session_state[f'{k}_error'] = None
+    st.session_state[f'{k}_df'] = prepare_layer(user_layer, colname,
+                                                grid_store['grid'].crs)
+    st.session_state[f'{k}_nbytes'] = layer_nbytes(st.session_state[f'{k}_df']['layer'])
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
-# 1.5. Convert aggregated results dataframe to excel file   
-def convert_df(df):
-    if st.session_state.aggregated_values:
-        output = BytesIO()
-        writer = pd.ExcelWriter(output, engine='openpyxl')
-        df.to_excel(writer, index=False, sheet_name='Sheet1') 
-        writer.close()
-        processed_data = output.getvalue()
-        return processed_data
+# 1.5. Export of the aggregated results, serialized only when downloaded
+def _export_data(df, drawing_buffer, extension, key):
+    # Deferred data of the download button, called on click in another thread
+    def _data():
+        run = new_run(kind = 'export', format = extension)
+        data = export_results(df, drawing_buffer, extension, key, run)
+        finish_run(run, 'ok')
+        return data
+    return _data
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# 1.6. Debug panel (hidden, open the app with ?debug=1): stages of the last
+# run, grid store and caches
+def _show_debug_panel():
+    run = st.session_state.get('last_run')
+    with st.sidebar.expander('Debug : dernier calcul'):
+        if run is None:
+            st.write('Aucun calcul.')
+        else:
+            st.write(f"{run['run_id']} ({run['started']}), statut : {run['status']}")
+            stages = pd.DataFrame(run['stages'])
+            stages[['wall_ms', 'cpu_ms']] = 1000 * stages[['wall_seconds', 'cpu_seconds']]
+            stages['rss_delta_mb'] = stages['rss_delta_bytes'] / 1e6
+            st.dataframe(stages.drop(columns = ['wall_seconds', 'cpu_seconds',
+                                                'rss_delta_bytes']).round(2),
+                         hide_index = True)
+    
+    # Grid store and caches of the server process
+    with st.sidebar.expander('Debug : serveur'):
+        st.dataframe(pd.DataFrame(
+            [(f'{prefix}_{field}', label_value, value)
+             for prefix, _, label_value, field, value in gauge_values()],
+            columns = ['mesure', 'objet', 'valeur']), hide_index = True)
     
 #------------------------------------------------------------------------------
 # 2. Page configuration
@@ -229,6 +418,8 @@ BTN_LABEL_CALCULATE = "Calculer valeurs agrégées"
 BTN_LABEL_DOWNLOAD = "Télécharger les données "
 MAP_CENTER = [46.201815,6.147738]
 MAP_ZOOM = 12
+# Memory available per session for the uploaded layers
+SESSION_MEMORY_BUDGET_MB = float(os.environ.get('SESSION_MEMORY_BUDGET_MB', 250))
 grid_url = './Data/Grid_All_Vars_Geneve_27_11_2023.gpkg'
 dict_colnames = {'P_comb_tim':'Acc. gravitaire TIM',
                  'P_comb_tc': 'Acc. gravitaire TP',
@@ -269,6 +460,7 @@ with tab1:
     
     st.write("\n")
     m = _show_map(center=MAP_CENTER, zoom=MAP_ZOOM)
+    _add_grid_overlay(m, grid_url, dict_colnames)
 
 with tab2:
     st.write("Afin d'ajouter vos propres données, cliquez sur la variable pour laquelle vous voulez remplacer les géodonnées. Pour enlever les données que vous avez ajoutées, cliquez sur la croix rouge (qui apparaîtra une fois que vous avez chargé des données) en dessous du bouton 'Browse files'.")
@@ -282,6 +474,15 @@ with tab2:
         if f'{k}_df' not in st.session_state:
             st.session_state[f'{k}_df'] = None
         
+        if f'{k}_df_colname' not in st.session_state:
+            st.session_state[f'{k}_df_colname'] = None
+        
+        if f'{k}_nbytes' not in st.session_state:
+            st.session_state[f'{k}_nbytes'] = 0
+        
+        if f'{k}_error' not in st.session_state:
+            st.session_state[f'{k}_error'] = None
+        
         if f'{k}_colnames' not in st.session_state:
             st.session_state[f'{k}_colnames'] = ['','']
         
@@ -304,7 +505,13 @@ with tab2:
                                         key = f'{k}_selected_colname',
                                         placeholder = 'Sélectionnez la colonne correspondante',
                                         disabled = not st.session_state[f'{k}_uploaded'])
-                if st.session_state[f'{k}_selected_colname'] is not None:
+                if (st.session_state[f'{k}_selected_colname'] is not None and
+                    st.session_state[f'{k}_selected_colname'] != st.session_state[f'{k}_df_colname']):
+                    with st.spinner('Chargement du document...'):
+                        _load_uploaded_column(k, grid_url)
+                if st.session_state[f'{k}_error'] is not None:
+                    st.error(st.session_state[f'{k}_error'])
+                elif st.session_state[f'{k}_selected_colname'] is not None:
                     st.write('Le document : ',st.session_state[f'{k}_filename'],
                              ' a été ajouté. La colonne', 
                              st.session_state[f'{k}_selected_colname'],
@@ -319,6 +526,12 @@ with tab2:
 progress_bar = st.sidebar.progress(0)
 progress_bar.empty()
 
+# Results of the calculation running in the background, or its progress
+_collect_calculation()
+if st.session_state.get('calculation_job') is not None:
+    with st.sidebar:
+        _show_calculation_progress()
+
 
 #------------------------------------------------------------------------------
 # 3. Get drawing and analyse data
@@ -336,6 +549,13 @@ output = st_folium(m,
 if output:
     if output["all_drawings"] is not None:
         geo_drawing = _drawing_to_gdf(output)
+        
+        # A new drawing supersedes the running calculation
+        drawing_fingerprint = geometry_fingerprint(geo_drawing.geometry.values[0],
+                                                   decimals = 7)
+        if drawing_fingerprint != st.session_state.get('drawing_fingerprint'):
+            _cancel_calculation()
+        st.session_state.drawing_fingerprint = drawing_fingerprint
 
 
 # Getting Started container
@@ -370,6 +590,21 @@ if output:
             """,
             unsafe_allow_html=True,
         )
+        
+        # Official perimeters, if their table was built (see perimeters.py)
+        perimeters = fetch_perimeters(grid_url)
+        if perimeters is not None:
+            with st.expander('Ou choisissez un périmètre officiel'):
+                perimeter_names = {(p.source, p.perimeter_id): f'{p.source} : {p.name}'
+                                   for p in perimeters.itertuples()}
+                st.selectbox('Périmètre', list(perimeter_names),
+                             format_func = perimeter_names.get,
+                             key = 'selected_perimeter', index = None,
+                             placeholder = 'Communes, secteurs, PLQ...')
+                st.button('Valeurs du périmètre',
+                          on_click = _compute_perimeter,
+                          kwargs = {'grid_url': grid_url},
+                          disabled = st.session_state.selected_perimeter is None)
 
         st.sidebar.markdown("---")
             
@@ -385,12 +620,50 @@ if output:
                                         df.columns[1]:'Valeurs'})
                 df = df.replace(dict_colnames)
                 st.data_editor(df)
-            csv = convert_df(df)
-            f_name = datetime.datetime.now().strftime('%d%m%Y_%H%M%S')
-            st.download_button(label = "Télécharger données agrégées", 
-                               data = csv,
-                               file_name = 'DonneesAgregees_'+f_name+'.xlsx')
+            # Displaying the results closes the run that computed them
+            run = st.session_state.get('last_run')
+            if (run is not None and not run['finished']
+                    and st.session_state.get('calculation_job') is None):
+                finish_run(run, 'ok')
+            if len(df)>0:
+                # Same results, same file: nothing is serialized before a download
+                drawing_buffer = st.session_state.drawing_buffer
+                export_key = result_hash(df, drawing_buffer)
+                extension = st.selectbox('Format', list(EXPORT_FORMATS),
+                                         format_func = lambda extension:
+                                             EXPORT_FORMATS[extension]['label'],
+                                         key = 'export_format')
+                st.download_button(label = "Télécharger données agrégées", 
+                                   data = _export_data(df, drawing_buffer,
+                                                       extension, export_key),
+                                   file_name = f'DonneesAgregees_{export_key[:8]}{extension}',
+                                   mime = EXPORT_FORMATS[extension]['mime'],
+                                   on_click = 'ignore')
+    
+    # Sensitivity analysis: several buffer distances, with / without the
+    # uploaded layers, in one calculation
+    with st.sidebar.expander('Analyse de sensibilité'):
+        if 'scenario_distances' not in st.session_state:
+            st.session_state.scenario_distances = BUFFER_DISTANCES
+        st.multiselect('Rayons du buffer (m)', BUFFER_DISTANCES,
+                       key = 'scenario_distances')
+        st.checkbox('Comparer avec et sans vos données', key = 'scenario_compare',
+                    disabled = not any(st.session_state.get(f'{k}_df') is not None
+                                       for k in dict_colnames))
+        st.button('Calculer les scénarios',
+                  on_click = _check_area_and_compute_avg,
+                  kwargs = {'geo_drawing': geo_drawing,
+                            'grid_url': grid_url,
+                            'progress_bar': progress_bar,
+                            'scenarios': True},
+                  disabled = (geo_drawing is None
+                              or not st.session_state.scenario_distances))
+        if st.session_state.get('scenario_values_df') is not None:
+            st.dataframe(st.session_state.scenario_values_df, hide_index = True)
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -                   
+# 3.3. Debug panel, only with ?debug=1 in the URL
+if st.query_params.get('debug') == '1':
+    _show_debug_panel()
 
 
 
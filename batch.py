@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless aggregation of the built-environment variables for many
+neighbourhood polygons at once (one output row per polygon, written chunk
+by chunk):
+
+    python batch.py quartiers.gpkg -o valeurs_agregees.csv
+    python batch.py quartiers.gpkg --layer perimetres --id-column NOM \
+        --user-layer B_DENS=batiments.gpkg:DENSITE --workers 4 \
+        -o valeurs_agregees.xlsx
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from aggregation import (BUFFER_DISTANCE, GRID_URL, aggregate_polygons,
+                         fetch_grid_store, prepare_user_layers)
+from export import values_writer
+
+#------------------------------------------------------------------------------
+# 1. Functions
+def _parse_user_layer(spec):
+    # VAR=path/to/layer.gpkg:column
+    var_name, _, source = spec.partition('=')
+    path, _, column = source.rpartition(':')
+    if not var_name or not path or not column:
+        raise argparse.ArgumentTypeError(
+            f"'{spec}' n'est pas au format VARIABLE=fichier.gpkg:colonne")
+    return var_name, path, column
+
+def _chunks(polygons, chunk_size):
+    n_chunks = max(int(np.ceil(len(polygons) / chunk_size)), 1)
+    return [polygons.iloc[rows]
+            for rows in np.array_split(np.arange(len(polygons)), n_chunks)]
+
+# Arguments shared by all the chunks of a worker process, sent once per worker
+_worker_args = {}
+
+def _init_worker(grid_url, buffer_distance, user_layers):
+    _worker_args.update(grid_url = grid_url, buffer_distance = buffer_distance,
+                        user_layers = user_layers)
+
+def _aggregate_chunk(chunk):
+    return aggregate_polygons(chunk, **_worker_args)
+
+def iter_aggregate_polygons(chunks, grid_url = GRID_URL,
+                            buffer_distance = BUFFER_DISTANCE,
+                            user_layers = None, workers = 1):
+    # Aggregated values of every chunk of polygons, in order; the user layers
+    # are prepared once, and with several workers the chunks are spread over
+    # a process pool (every worker loads the grid and gets the prepared
+    # layers once)
+    user_layers = prepare_user_layers(user_layers,
+                                      fetch_grid_store(grid_url)['grid'].crs)
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield aggregate_polygons(chunk, grid_url, buffer_distance,
+                                     user_layers)
+        return
+    
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                             initargs = (grid_url, buffer_distance,
+                                         user_layers)) as pool:
+        yield from pool.map(_aggregate_chunk, chunks)
+
+def aggregate_polygons_parallel(polygons, grid_url = GRID_URL,
+                                buffer_distance = BUFFER_DISTANCE,
+                                user_layers = None, workers = 1,
+                                chunk_size = 1000):
+    # Same as aggregate_polygons, large inputs are split in chunks spread over
+    # a process pool
+    if workers <= 1 or len(polygons) <= chunk_size:
+        return aggregate_polygons(polygons, grid_url, buffer_distance,
+                                  user_layers)
+    return pd.concat(list(iter_aggregate_polygons(
+        _chunks(polygons, chunk_size), grid_url, buffer_distance,
+        user_layers, workers)))
+
+def write_values(values, polygons, output):
+    # Output format from the file extension, see export.values_writer
+    with values_writer(output) as write:
+        write(values, polygons.geometry)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Valeurs agrégées des variables territoriales pour "
+                      "chaque polygone d'une couche (GeoPackage, GeoJSON...)")
+    parser.add_argument('polygons', help = 'couche des quartiers')
+    parser.add_argument('-o', '--output', required = True,
+                        help = 'fichier de sortie (.csv, .xlsx, .parquet, .gpkg, .geojson)')
+    parser.add_argument('--layer', default = None,
+                        help = 'nom de la couche dans le fichier des quartiers')
+    parser.add_argument('--id-column', default = None,
+                        help = 'colonne identifiant les quartiers')
+    parser.add_argument('--grid', default = GRID_URL,
+                        help = 'grille des variables territoriales')
+    parser.add_argument('--buffer', type = float, default = BUFFER_DISTANCE,
+                        help = 'rayon du buffer autour des quartiers (m)')
+    parser.add_argument('--user-layer', action = 'append', default = [],
+                        type = _parse_user_layer,
+                        metavar = 'VARIABLE=fichier.gpkg:colonne',
+                        help = 'remplace une variable de la grille')
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = 'nombre de processus')
+    parser.add_argument('--chunk-size', type = int, default = 1000,
+                        help = 'nombre de polygones par processus et par lot')
+    args = parser.parse_args(argv)
+    
+    polygons = gpd.read_file(args.polygons, layer = args.layer)
+    if args.id_column is not None:
+        polygons = polygons.set_index(args.id_column)
+    user_layers = {var_name: (gpd.read_file(path), column)
+                   for var_name, path, column in args.user_layer}
+    
+    # Every chunk is written as soon as it is aggregated
+    chunks = _chunks(polygons, args.chunk_size)
+    with values_writer(args.output) as write:
+        for chunk, values in zip(chunks, iter_aggregate_polygons(
+                chunks, args.grid, args.buffer, user_layers, args.workers)):
+            write(values, chunk.geometry)
+
+if __name__ == '__main__':
+    main()
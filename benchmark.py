@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the aggregation path of the web app (grid loading,
+boundary check, aggregation, export in every format), on the Geneva grid
+and on synthetic upscaled grids, with random, concave and high-vertex-count
+neighbourhood polygons and synthetic user layers:
+
+    python benchmark.py -o benchmarks/resultats.json
+    python benchmark.py --quick -o benchmarks/resultats.json
+
+Latency percentiles (ms) and peak Python memory (bytes, tracemalloc) are
+saved per stage as JSON, to compare releases of the app.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from aggregation import (GRID_URL, LATTICE_TOLERANCE, _intersection_weights,
+                         _lattice_intersection_weights, clear_caches,
+                         drawing_in_boundary, fetch_data, fetch_grid_store,
+                         prepare_layer, update_aggregates)
+from export import EXPORT_FORMATS, serialize_results
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+GRID_SCALES = [1, 2, 4]
+POLYGON_KINDS = {'random': 12, 'concave': 24, 'high_vertex': 5000}
+POLYGON_RADII = [100, 500, 2000]
+USER_LAYER_SIZES = [1000, 10000, 100000]
+USER_LAYER_VARIABLE = 'B_DENS'
+REPEAT = 20
+LOAD_REPEAT = 3
+PERCENTILES = [50, 90, 95, 99]
+
+#------------------------------------------------------------------------------
+# 2. Synthetic data
+def upscaled_grid(grid_url, scale, output_dir):
+    # The grid tiled scale x scale times side by side (shifted by whole
+    # lattice extents, so that the copies stay on the same 500 m lattice)
+    if scale == 1:
+        return grid_url
+    grid = gpd.read_file(grid_url)
+    xmin, ymin, xmax, ymax = grid.total_bounds
+    width = np.ceil((xmax - xmin) / 500) * 500
+    height = np.ceil((ymax - ymin) / 500) * 500
+    tiles = [grid.set_geometry(grid.translate(i * width, j * height))
+             for i in range(scale) for j in range(scale)]
+    url = os.path.join(output_dir, f'grid_x{scale}.gpkg')
+    gpd.GeoDataFrame(pd.concat(tiles, ignore_index = True),
+                     crs = grid.crs).to_file(url)
+    return url
+
+def random_polygon(rng, center, radius, kind):
+    # Star-shaped polygon around center (grid CRS): irregular convex-like
+    # outline ('random'), alternating inner / outer vertices ('concave') or
+    # thousands of vertices ('high_vertex')
+    n_vertices = POLYGON_KINDS[kind]
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+    if kind == 'concave':
+        angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint = False)
+        radii = np.where(np.arange(n_vertices) % 2 == 0, radius, 0.3 * radius)
+    elif kind == 'high_vertex':
+        # Wavy outline with a jitter of a quarter of the vertex spacing, like a
+        # digitized perimeter (spikier outlines make GEOS' buffer superlinear)
+        waves = np.arange(1, 9)
+        radii = radius * (1 + (rng.uniform(-0.1, 0.1, 8) / waves
+                               * np.sin(np.outer(angles, waves)
+                                        + rng.uniform(0, 2 * np.pi, 8))).sum(axis = 1))
+        radii += 0.25 * 2 * np.pi * radius / n_vertices * rng.standard_normal(n_vertices)
+    else:
+        radii = radius * rng.uniform(0.7, 1, n_vertices)
+    polygon = shapely.Polygon(np.column_stack([center[0] + radii * np.cos(angles),
+                                               center[1] + radii * np.sin(angles)]))
+    return shapely.make_valid(polygon) if not polygon.is_valid else polygon
+
+def random_drawing(rng, grid_store, radius, kind):
+    # Drawing as received from the map (one polygon, WGS84), centred on a
+    # random grid cell
+    grid = grid_store['grid']
+    center = shapely.get_coordinates(
+        grid.geometry.values[rng.integers(len(grid))].centroid)[0]
+    polygon = random_polygon(rng, center, radius, kind)
+    return gpd.GeoDataFrame(index = [0], geometry = [polygon],
+                            crs = grid.crs).to_crs(4326)
+
+def random_user_layer(rng, grid_store, n_features):
+    # Building-like squares (10 to 30 m) spread over the grid's extent
+    xmin, ymin, xmax, ymax = grid_store['grid'].total_bounds
+    x = rng.uniform(xmin, xmax, n_features)
+    y = rng.uniform(ymin, ymax, n_features)
+    size = rng.uniform(10, 30, n_features)
+    return gpd.GeoDataFrame({'DENS': rng.uniform(0, 1, n_features)},
+                            geometry = shapely.box(x, y, x + size, y + size),
+                            crs = grid_store['grid'].crs)
+
+#------------------------------------------------------------------------------
+# 3. Measures
+def _record(stages, stage, seconds):
+    stages.setdefault(stage, {'seconds': [], 'peak_bytes': 0})['seconds'].append(seconds)
+
+def _timed(stages, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    _record(stages, stage, time.perf_counter() - start)
+    return result
+
+def _traced(stages, stage, function, *args, **kwargs):
+    # Untimed run under tracemalloc, for the stage's peak Python memory
+    tracemalloc.start()
+    try:
+        result = function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    stages.setdefault(stage, {'seconds': [], 'peak_bytes': 0})
+    stages[stage]['peak_bytes'] = max(stages[stage]['peak_bytes'], peak)
+    return result
+
+def _summary(stages):
+    summary = {}
+    for stage, measures in stages.items():
+        ms = 1000 * np.asarray(measures['seconds'])
+        summary[stage] = {'n': len(ms),
+                          'mean_ms': float(ms.mean()),
+                          'min_ms': float(ms.min()),
+                          'max_ms': float(ms.max()),
+                          'peak_bytes': int(measures['peak_bytes'])}
+        summary[stage].update({f'p{q}_ms': float(np.percentile(ms, q))
+                               for q in PERCENTILES})
+    return summary
+
+def lattice_weight_difference(grid_store, geom):
+    # Max. difference between the lattice and the polygon overlay weights
+    # (shares of geom's intersected area) of the grid cells in geom
+    lattice = grid_store['lattice']
+    flat_rows, lattice_weights = _lattice_intersection_weights(lattice, geom)
+    _, rows, weights = _intersection_weights(grid_store['grid'], [geom])
+    differences = np.zeros(len(grid_store['grid']))
+    np.add.at(differences, lattice['cell_index'].ravel()[flat_rows], lattice_weights)
+    np.subtract.at(differences, rows, weights)
+    return float(np.abs(differences).max(initial = 0))
+
+def _run_drawing(stages, grid_store, drawing, user_layers = None, trace = False):
+    # The steps of _check_area_and_compute_avg and of the export, the
+    # aggregation once from scratch and once from the result cache; returns
+    # the lattice weight difference (None without lattice)
+    run = _traced if trace else _timed
+    geo_drawing = run(stages, 'to_crs', drawing.to_crs, grid_store['grid'].crs)
+    run(stages, 'drawing_in_boundary', drawing_in_boundary,
+        grid_store['boundary'], geo_drawing)
+    clear_caches(grids = False)
+    state = run(stages, 'compute_avg', update_aggregates,
+                grid_store, geo_drawing, user_layers)
+    run(stages, 'compute_avg_cached', update_aggregates,
+        grid_store, geo_drawing, user_layers)
+    for extension in EXPORT_FORMATS:
+        run(stages, f'export_{extension[1:]}', serialize_results,
+            state['values_df'], state['drawing_buffer'], extension)
+    
+    # The lattice fast path must give the weights of the polygon overlay
+    if grid_store['lattice'] is None:
+        return None
+    difference = lattice_weight_difference(
+        grid_store, state['drawing_buffer'].geometry.values[0])
+    if difference > LATTICE_TOLERANCE:
+        raise RuntimeError(f"Poids de la grille régulière différents de ceux de "
+                           f"l'intersection des polygones : {difference:.3g}")
+    return difference
+
+def bench_grid(grid_url, repeat, load_repeat, radii, kinds, rng):
+    # Grid loading (cold and warm) then every polygon kind and radius
+    results = []
+    stages = {}
+    for _ in range(load_repeat):
+        clear_caches()
+        _timed(stages, 'fetch_data', fetch_data, grid_url)
+    _timed(stages, 'fetch_data_warm', fetch_data, grid_url)
+    clear_caches()
+    _traced(stages, 'fetch_data', fetch_data, grid_url)
+    grid_store = fetch_grid_store(grid_url)
+    results.append({'case': 'grid', 'stages': _summary(stages)})
+    
+    for kind in kinds:
+        for radius in radii:
+            stages = {}
+            differences = []
+            for i in range(repeat + 1):
+                drawing = random_drawing(rng, grid_store, radius, kind)
+                differences.append(_run_drawing(stages, grid_store, drawing,
+                                                trace = i == repeat))
+            results.append({'case': 'drawing',
+                            'polygon_kind': kind,
+                            'radius_m': radius,
+                            'n_vertices': POLYGON_KINDS[kind],
+                            'lattice_max_weight_difference':
+                                (max(differences) if grid_store['lattice'] is not None
+                                 else None),
+                            'stages': _summary(stages)})
+    return grid_store, results
+
+def bench_user_layers(grid_store, sizes, repeat, rng):
+    # Preparation of an uploaded layer, then aggregation with it
+    crs = grid_store['grid'].crs
+    results = []
+    for n_features in sizes:
+        stages = {}
+        layer = random_user_layer(rng, grid_store, n_features)
+        prepared = _timed(stages, 'prepare_layer', prepare_layer, layer, 'DENS', crs)
+        _traced(stages, 'prepare_layer', prepare_layer, layer, 'DENS', crs)
+        for i in range(repeat + 1):
+            drawing = random_drawing(rng, grid_store, 500, 'random')
+            _run_drawing(stages, grid_store, drawing,
+                         {USER_LAYER_VARIABLE: prepared}, trace = i == repeat)
+        results.append({'case': 'user_layer',
+                        'n_features': n_features,
+                        'stages': _summary(stages)})
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True,
+                              text = True, check = True,
+                              cwd = os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(grid_url = GRID_URL, scales = GRID_SCALES, radii = POLYGON_RADII,
+                  kinds = list(POLYGON_KINDS), user_layer_sizes = USER_LAYER_SIZES,
+                  repeat = REPEAT, load_repeat = LOAD_REPEAT, seed = 0):
+    """
+    Run the benchmark and return its report: environment, parameters and, for
+    every grid scale and case, the latency percentiles and peak memory of
+    every stage.
+    """
+    rng = np.random.default_rng(seed)
+    grids = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scale in scales:
+            url = upscaled_grid(grid_url, scale, tmp_dir)
+            grid_store, results = bench_grid(url, repeat, load_repeat, radii,
+                                             kinds, rng)
+            if scale == scales[0]:
+                results += bench_user_layers(grid_store, user_layer_sizes,
+                                             repeat, rng)
+            grids.append({'scale': scale,
+                          'n_cells': len(grid_store['grid']),
+                          'lattice': grid_store['lattice'] is not None,
+                          'results': results})
+        clear_caches()
+    
+    return {'date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'versions': {'geopandas': gpd.__version__,
+                         'shapely': shapely.__version__,
+                         'geos': shapely.geos_version_string,
+                         'pandas': pd.__version__,
+                         'numpy': np.__version__},
+            'parameters': {'grid': os.path.basename(grid_url),
+                           'scales': scales,
+                           'radii_m': radii,
+                           'polygon_kinds': {kind: POLYGON_KINDS[kind]
+                                             for kind in kinds},
+                           'user_layer_sizes': user_layer_sizes,
+                           'repeat': repeat,
+                           'load_repeat': load_repeat,
+                           'seed': seed},
+            # kilobytes on Linux
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'grids': grids}
+
+#------------------------------------------------------------------------------
+# 4. Command line
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Mesure les temps et la mémoire du calcul des valeurs "
+                      "agrégées, par étape")
+    parser.add_argument('-o', '--output', required = True,
+                        help = 'fichier de résultats (.json)')
+    parser.add_argument('--grid', default = GRID_URL,
+                        help = 'grille des variables territoriales')
+    parser.add_argument('--scales', type = int, nargs = '+', default = GRID_SCALES,
+                        help = 'agrandissements de la grille (n x n copies)')
+    parser.add_argument('--radii', type = float, nargs = '+', default = POLYGON_RADII,
+                        help = 'rayons des polygones (m)')
+    parser.add_argument('--user-layer-sizes', type = int, nargs = '+',
+                        default = USER_LAYER_SIZES,
+                        help = "nombres d'entités des couches utilisateur")
+    parser.add_argument('--repeat', type = int, default = REPEAT,
+                        help = 'nombre de polygones par cas')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--quick', action = 'store_true',
+                        help = 'grille de Genève seulement, peu de répétitions')
+    args = parser.parse_args(argv)
+    
+    if args.quick:
+        args.scales, args.repeat = [1], 5
+        args.user_layer_sizes = args.user_layer_sizes[:2]
+    report = run_benchmark(args.grid, args.scales, args.radii,
+                           user_layer_sizes = args.user_layer_sizes,
+                           repeat = args.repeat, seed = args.seed,
+                           load_repeat = 1 if args.quick else LOAD_REPEAT)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok = True)
+    with open(args.output, 'w', encoding = 'utf-8') as f:
+        json.dump(report, f, indent = 2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Export of the aggregated values: the results of the web app, serialized only
+when downloaded and memoized by result hash, and the streaming writers of
+batch.py (one row per polygon, written chunk by chunk).
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import hashlib
+import importlib.util
+import os
+from contextlib import contextmanager
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from instrumentation import register_gauges, stage
+from result_cache import ResultCache
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+# Formats of the web app, by file extension (Parquet only if pyarrow is installed)
+EXPORT_FORMATS = {
+    '.csv': {'label': 'CSV', 'mime': 'text/csv'},
+    '.xlsx': {'label': 'Excel',
+              'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    '.parquet': {'label': 'Parquet', 'mime': 'application/vnd.apache.parquet'},
+    '.gpkg': {'label': 'GeoPackage', 'mime': 'application/geopackage+sqlite3'}}
+if importlib.util.find_spec('pyarrow') is None:
+    del EXPORT_FORMATS['.parquet']
+
+EXPORT_CACHE_MAX_ENTRIES = 64
+EXPORT_CACHE_MAX_BYTES = 64e6
+GPKG_LAYER = 'valeurs_agregees'
+
+#------------------------------------------------------------------------------
+# 2. Results of the web app
+_exports = ResultCache(max_entries = EXPORT_CACHE_MAX_ENTRIES,
+                       max_bytes = EXPORT_CACHE_MAX_BYTES)
+
+def result_hash(values_df, drawing_buffer):
+    # Hash of the values table and of the buffer they were aggregated in
+    sha1 = hashlib.sha1(pd.util.hash_pandas_object(values_df.astype(str),
+                                                   index = False).values)
+    for wkb in shapely.to_wkb(drawing_buffer.geometry.values):
+        sha1.update(wkb)
+    return sha1.hexdigest()
+
+def _wide_values(values_df):
+    # One column per variable (first column), each with its own type
+    return pd.DataFrame([values_df.iloc[:, 1].to_numpy()],
+                        columns = values_df.iloc[:, 0].to_numpy()).infer_objects()
+
+def serialize_results(values_df, drawing_buffer, extension):
+    """
+    File contents of the results: the table as displayed for CSV and Excel,
+    one column per variable for Parquet and GeoPackage (the latter with the
+    drawing's buffer as geometry).
+    """
+    output = BytesIO()
+    if extension == '.csv':
+        # With a BOM, so that spreadsheets read the accents
+        values_df.to_csv(output, index = False, encoding = 'utf-8-sig')
+    elif extension == '.xlsx':
+        values_df.to_excel(output, index = False, sheet_name = 'Sheet1')
+    elif extension == '.parquet':
+        _wide_values(values_df).to_parquet(output, index = False)
+    elif extension == '.gpkg':
+        gpd.GeoDataFrame(_wide_values(values_df),
+                         geometry = drawing_buffer.geometry.values,
+                         crs = drawing_buffer.crs).to_file(output, driver = 'GPKG',
+                                                           layer = GPKG_LAYER)
+    else:
+        raise ValueError(f"Format de sortie non supporté : '{extension}'")
+    return output.getvalue()
+
+def export_results(values_df, drawing_buffer, extension, key = None, run = None):
+    # serialize_results, memoized by result hash (key, computed if None)
+    key = (key or result_hash(values_df, drawing_buffer), extension)
+    data = _exports.get(key)
+    if data is None:
+        with stage(run, f'export_{extension[1:]}') as record:
+            data = serialize_results(values_df, drawing_buffer, extension)
+            record['rows'] = len(values_df)
+        _exports.put(key, data, nbytes = len(data))
+    return data
+
+def export_cache_stats():
+    return {'exports': _exports.stats()}
+
+register_gauges('cache', 'cache', export_cache_stats)
+
+#------------------------------------------------------------------------------
+# 3. Batch
+def _cell(value):
+    # openpyxl would write NaN as an invalid number
+    return None if isinstance(value, float) and np.isnan(value) else value
+
+@contextmanager
+def values_writer(output):
+    """
+    Streaming writer of aggregated values (one row per polygon, indexed by
+    polygon) in the format of output's extension: .csv, .xlsx, .parquet, or
+    .gpkg / .geojson (values joined to the polygons' geometry). Yields
+    write(values, geometry = None), called once per chunk of polygons: only
+    the current chunk is held in memory.
+    """
+    extension = os.path.splitext(output)[1].lower()
+    if extension == '.csv':
+        with open(output, 'w', newline = '', encoding = 'utf-8') as f:
+            def write(values, geometry = None):
+                values.to_csv(f, header = f.tell() == 0)
+            yield write
+    
+    elif extension == '.xlsx':
+        import openpyxl
+        # Write-only workbook: rows are flushed to a temporary file as appended
+        workbook = openpyxl.Workbook(write_only = True)
+        sheet = workbook.create_sheet('Sheet1')
+        n_rows = 0
+        def write(values, geometry = None):
+            nonlocal n_rows
+            if n_rows == 0:
+                sheet.append([values.index.name] + list(values.columns))
+            for row in values.itertuples(name = None):
+                sheet.append([_cell(value) for value in row])
+            n_rows += len(values)
+        yield write
+        workbook.save(output)
+    
+    elif extension == '.parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        def write(values, geometry = None):
+            nonlocal writer
+            if writer is None:
+                # Schema of the first chunk, columns without any value as text
+                schema = pa.Schema.from_pandas(values, preserve_index = True)
+                schema = pa.schema([field.with_type(pa.string())
+                                    if pa.types.is_null(field.type) else field
+                                    for field in schema], schema.metadata)
+                writer = pq.ParquetWriter(output, schema)
+            writer.write_table(pa.Table.from_pandas(values, schema = writer.schema,
+                                                    preserve_index = True))
+        try:
+            yield write
+        finally:
+            if writer is not None:
+                writer.close()
+    
+    elif extension in ['.gpkg', '.geojson']:
+        n_rows = 0
+        def write(values, geometry = None):
+            nonlocal n_rows
+            gpd.GeoDataFrame(values, geometry = geometry).reset_index().to_file(
+                output, mode = 'a' if n_rows else 'w')
+            n_rows += len(values)
+        yield write
+    
+    else:
+        raise ValueError(f"Format de sortie non supporté : '{extension}'")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage measures of the calculations (wall time, CPU time, rows
+intersected, RSS delta), emitted as one JSON log line per calculation and,
+if METRICS_FILE is set, accumulated in a Prometheus text file (e.g. for
+node_exporter's textfile collector), together with the gauges registered by
+the other modules (grid store, caches).
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+METRICS_FILE = os.environ.get('METRICS_FILE')
+METRICS_PREFIX = 'co2_quartiers'
+
+logger = logging.getLogger(__name__)
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+#------------------------------------------------------------------------------
+# 2. Measures
+# Totals per stage over all the runs of the process: count, wall, cpu, rows
+_totals = {}
+_totals_lock = threading.Lock()
+
+def _rss_bytes():
+    # Current resident memory of the process, None where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def new_run(**context):
+    # A calculation request: its stages are appended by stage()
+    return {'run_id': uuid.uuid4().hex[:12],
+            'started': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'context': context,
+            'stages': [],
+            'status': None,
+            'finished': False}
+
+@contextmanager
+def stage(run, name):
+    """
+    Measure the enclosed block as stage name of run (no-op if run is None).
+    The yielded record can be completed by the block, e.g. record['rows'].
+    CPU time is the calling thread's; the RSS delta is the whole process'.
+    """
+    record = {'stage': name, 'rows': None}
+    if run is None:
+        yield record
+        return
+    
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    rss_start = _rss_bytes()
+    try:
+        yield record
+    finally:
+        rss_end = _rss_bytes()
+        record.update(wall_seconds = time.perf_counter() - wall_start,
+                      cpu_seconds = time.thread_time() - cpu_start,
+                      rss_delta_bytes = (rss_end - rss_start
+                                         if rss_start is not None else None))
+        run['stages'].append(record)
+
+def record_error(run, error):
+    # Log the exception that ended run, with its traceback, and add it to run
+    logger.error(f"Run {run['run_id']} failed", exc_info = error)
+    run['error'] = f'{type(error).__name__}: {error}'
+
+def finish_run(run, status):
+    # Log the run as one JSON line and add its stages to the process totals
+    if run['finished']:
+        return
+    run['status'] = status
+    run['finished'] = True
+    run['wall_seconds'] = sum(record['wall_seconds'] for record in run['stages'])
+    logger.info(json.dumps({'event': 'calculation', **run}, default = str))
+    
+    with _totals_lock:
+        for record in run['stages']:
+            totals = _totals.setdefault(record['stage'],
+                                        {'count': 0, 'wall_seconds': 0.0,
+                                         'cpu_seconds': 0.0, 'rows': 0})
+            totals['count'] += 1
+            totals['wall_seconds'] += record['wall_seconds']
+            totals['cpu_seconds'] += record['cpu_seconds']
+            totals['rows'] += record['rows'] or 0
+    if METRICS_FILE:
+        write_metrics(METRICS_FILE)
+
+# Gauges of the other modules (grid store, caches...), read at every export
+_gauges = []
+
+def register_gauges(prefix, label, function):
+    """
+    Register function() -> {label value: {field: number}}, exported as the
+    gauges <METRICS_PREFIX>_<prefix>_<field>{<label>="<label value>"}.
+    """
+    _gauges.append((prefix, label, function))
+
+def gauge_values():
+    # Current (prefix, label, label value, field, value) of every gauge
+    return [(prefix, label, label_value, field, value)
+            for prefix, label, function in _gauges
+            for label_value, fields in function().items()
+            for field, value in fields.items()]
+
+#------------------------------------------------------------------------------
+# 3. Export
+def prometheus_text():
+    # Stage totals in the Prometheus text exposition format
+    with _totals_lock:
+        totals = {name: dict(values) for name, values in _totals.items()}
+    lines = []
+    for metric, key, help_text in [
+            ('stage_runs_total', 'count', 'Number of runs of the stage'),
+            ('stage_wall_seconds_total', 'wall_seconds', 'Wall time of the stage'),
+            ('stage_cpu_seconds_total', 'cpu_seconds', 'CPU time of the stage'),
+            ('stage_rows_total', 'rows', 'Rows processed by the stage')]:
+        name = f'{METRICS_PREFIX}_{metric}'
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        lines += [f'{name}{{stage="{stage_name}"}} {values[key]}'
+                  for stage_name, values in sorted(totals.items())]
+    
+    gauges = {}
+    for prefix, label, label_value, field, value in gauge_values():
+        gauges.setdefault(f'{METRICS_PREFIX}_{prefix}_{field}', []).append(
+            f'{{{label}="{label_value}"}} {value}')
+    for name, samples in sorted(gauges.items()):
+        lines += [f'# TYPE {name} gauge'] + [name + sample for sample in samples]
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path):
+    # Written to a temporary file first, so that readers never see half a file
+    # (one per call: runs of different threads can finish at the same time)
+    fd, tmp_path = tempfile.mkstemp(suffix = '.tmp',
+                                    dir = os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(prometheus_text())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background calculations: jobs run in a worker pool shared by all sessions of
+the server process, with a server-wide limit on the number of pending jobs,
+progress reporting and cooperative cancellation.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+# Jobs running at the same time, and jobs running or queued at the same time
+CALCULATION_WORKERS = int(os.environ.get('CALCULATION_WORKERS', 2))
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 8))
+# Interval at which the web app polls the progress of a job (s)
+JOB_POLL_SECONDS = 0.5
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_CANCELLED = 'cancelled'
+JOB_FAILED = 'failed'
+
+#------------------------------------------------------------------------------
+# 2. Jobs
+class JobCancelled(Exception):
+    pass
+
+class ServerBusy(Exception):
+    pass
+
+_executor = ThreadPoolExecutor(max_workers = CALCULATION_WORKERS,
+                               thread_name_prefix = 'calculation')
+_pending = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+
+def submit_job(function, *args, **kwargs):
+    """
+    Run function(*args, on_progress = ..., **kwargs) in the worker pool and
+    return the job. on_progress(n_done, n_total, name) records the job's
+    progress and raises JobCancelled once the job is cancelled. Raises
+    ServerBusy when MAX_PENDING_JOBS jobs are already running or queued.
+    """
+    if not _pending.acquire(blocking = False):
+        raise ServerBusy()
+    job = {'job_id': uuid.uuid4().hex[:12],
+           'progress': 0.0,
+           'cancel_event': threading.Event()}
+    
+    def _on_progress(n_done, n_total, name = None):
+        if job['cancel_event'].is_set():
+            raise JobCancelled()
+        job['progress'] = n_done / n_total if n_total else 1.0
+    
+    def _run():
+        _on_progress(0, 1)
+        return function(*args, on_progress = _on_progress, **kwargs)
+    
+    try:
+        job['future'] = _executor.submit(_run)
+    except BaseException:
+        _pending.release()
+        raise
+    job['future'].add_done_callback(lambda future: _pending.release())
+    return job
+
+def cancel_job(job):
+    # A queued job never starts, a running job stops at its next progress
+    job['cancel_event'].set()
+    job['future'].cancel()
+
+def job_status(job):
+    future = job['future']
+    if future.cancelled():
+        return JOB_CANCELLED
+    if not future.done():
+        return JOB_RUNNING if future.running() else JOB_QUEUED
+    if isinstance(future.exception(), JobCancelled):
+        return JOB_CANCELLED
+    return JOB_FAILED if future.exception() is not None else JOB_DONE
+
+def job_result(job):
+    # Result of a finished job (re-raises its exception if it failed)
+    return job['future'].result()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Map overlays of the grid variables and of the canton boundary.
+
+The overlays are built offline from the grid geopackage, as simplified and
+quantized GeoJSON files (one per zoom level) served as static files:
+
+    python overlays.py
+
+The web app then only sends their URLs to the map: the browser downloads the
+level matching its zoom once, and the variables are toggled client side.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from branca.element import MacroElement
+from jinja2 import Template
+
+from aggregation import (GRID_URL, boundary_sidecar_path, fetch_grid_store,
+                         is_numeric_variable)
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+OVERLAY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'static', 'overlays')
+# Served by Streamlit with server.enableStaticServing (see .streamlit/config.toml)
+OVERLAY_URL = '/app/static/overlays'
+OVERLAY_META = 'overlays.json'
+
+# Zoom levels: simplification tolerance (m, grid CRS) from the given zoom on
+OVERLAY_LEVELS = [{'min_zoom': 0, 'tolerance': 50},
+                  {'min_zoom': 11, 'tolerance': 10},
+                  {'min_zoom': 14, 'tolerance': 0}]
+# Decimals kept for the WGS84 coordinates (5 decimals ~ 1 m)
+COORDINATE_DECIMALS = 5
+N_CLASSES = 5
+NUMERIC_COLORS = ['#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026']
+CATEGORY_COLORS = ['#1b9e77', '#d95f02', '#7570b3', '#e7298a', '#66a61e',
+                   '#e6ab02', '#a6761d', '#666666', '#a6cee3', '#fb9a99']
+
+#------------------------------------------------------------------------------
+# 2. Offline build
+def _variable_classes(values):
+    # Quantile classes for numeric variables, one class per category
+    # otherwise; returns the class of every cell (-1 = no data) and the legend
+    if is_numeric_variable(values.dtype):
+        breaks = np.unique(np.nanquantile(values.dropna(),
+                                          np.linspace(0, 1, N_CLASSES + 1)))
+        classes = np.clip(np.searchsorted(breaks, values, side = 'right') - 1,
+                          0, max(len(breaks) - 2, 0))
+        classes[values.isna().to_numpy()] = -1
+        labels = [f'{lo:.3g} - {hi:.3g}' for lo, hi in zip(breaks[:-1], breaks[1:])]
+        colors = [NUMERIC_COLORS[round(i * (N_CLASSES - 1) / max(len(labels) - 1, 1))]
+                  for i in range(len(labels))]
+    else:
+        codes, categories = pd.factorize(values, sort = True)
+        classes = codes
+        labels = [str(category) for category in categories]
+        colors = [CATEGORY_COLORS[i % len(CATEGORY_COLORS)]
+                  for i in range(len(labels))]
+    return classes, {'labels': labels, 'colors': colors}
+
+def _quantized_geojson(geoms, properties):
+    # FeatureCollection with WGS84 coordinates rounded to COORDINATE_DECIMALS
+    geoms = shapely.transform(geoms,
+                              lambda coords: np.round(coords, COORDINATE_DECIMALS))
+    features = [{'type': 'Feature',
+                 'properties': feature_properties,
+                 'geometry': json.loads(geometry)}
+                for geometry, feature_properties
+                in zip(shapely.to_geojson(geoms), properties)]
+    return {'type': 'FeatureCollection', 'features': features}
+
+def _write_json(data, path):
+    with open(path, 'w', encoding = 'utf-8') as f:
+        json.dump(data, f, ensure_ascii = False, separators = (',', ':'))
+
+def build_overlays(grid_url = GRID_URL, output_dir = OVERLAY_DIR):
+    # Writes the grid and boundary GeoJSON of every zoom level, the metadata
+    # (levels, legends, grid hash) and the boundary sidecar of the grid
+    grid_store = fetch_grid_store(grid_url)
+    grid = grid_store['grid']
+    var_names = grid_store['matrices']['var_names']
+    os.makedirs(output_dir, exist_ok = True)
+    
+    # Cell properties: only the class of every variable ('c', in the order of
+    # the variables' legends) to keep the files small
+    legends = []
+    cell_classes = []
+    for var_name in var_names:
+        classes, legend = _variable_classes(grid[var_name])
+        cell_classes.append(classes)
+        legends.append(dict(legend, name = var_name))
+    properties = [{'c': [int(c) if c >= 0 else None for c in classes]}
+                  for classes in np.column_stack(cell_classes)]
+    
+    # Canton outline, also saved as the grid's boundary sidecar
+    boundary = grid.geometry.union_all()
+    gpd.GeoDataFrame({'grid_sha1': [grid_store['sha1']]}, geometry = [boundary],
+                     crs = grid.crs).to_file(boundary_sidecar_path(grid_url))
+    
+    levels = []
+    for level in OVERLAY_LEVELS:
+        cells = grid.geometry.values
+        outline = boundary
+        if level['tolerance'] > 0:
+            cells = shapely.coverage_simplify(cells, level['tolerance'])
+            outline = shapely.simplify(boundary, level['tolerance'])
+        cells = gpd.GeoSeries(cells, crs = grid.crs).to_crs(4326).values
+        outline = gpd.GeoSeries([outline], crs = grid.crs).to_crs(4326).values
+        
+        grid_file = f"grid_z{level['min_zoom']}.geojson"
+        boundary_file = f"boundary_z{level['min_zoom']}.geojson"
+        _write_json(_quantized_geojson(cells, properties),
+                    os.path.join(output_dir, grid_file))
+        _write_json(_quantized_geojson(outline, [{}]),
+                    os.path.join(output_dir, boundary_file))
+        levels.append({'min_zoom': level['min_zoom'],
+                       'grid': grid_file,
+                       'boundary': boundary_file})
+    
+    _write_json({'grid_sha1': grid_store['sha1'],
+                 'levels': levels,
+                 'variables': legends},
+                os.path.join(output_dir, OVERLAY_META))
+
+#------------------------------------------------------------------------------
+# 3. Map layer
+def load_overlay_meta(grid_sha1, output_dir = OVERLAY_DIR):
+    # Overlay metadata, None if the overlays are missing or were built from
+    # another version of the grid
+    path = os.path.join(output_dir, OVERLAY_META)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding = 'utf-8') as f:
+        meta = json.load(f)
+    if meta['grid_sha1'] != grid_sha1:
+        return None
+    return meta
+
+class GridOverlay(MacroElement):
+    # Boundary outline and one toggleable choropleth per variable, fetched by
+    # the browser from the static overlay files matching the map's zoom
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var levels = {{ this.levels|tojson }};
+            var variables = {{ this.variables|tojson }};
+            var cache = {};
+
+            function levelFor(zoom) {
+                var level = levels[0];
+                levels.forEach(function(l) { if (zoom >= l.min_zoom) { level = l; } });
+                return level;
+            }
+            function load(url) {
+                if (!(url in cache)) {
+                    cache[url] = fetch(url).then(function(r) { return r.json(); });
+                }
+                return cache[url];
+            }
+            function zoomLayer(file, options) {
+                var layer = L.geoJSON(null, options);
+                var current = null;
+                function refresh() {
+                    if (!map.hasLayer(layer)) { return; }
+                    var url = levelFor(map.getZoom())[file];
+                    if (url === current) { return; }
+                    current = url;
+                    load(url).then(function(data) {
+                        if (current === url) { layer.clearLayers(); layer.addData(data); }
+                    });
+                }
+                layer.on('add', refresh);
+                map.on('zoomend', refresh);
+                return layer;
+            }
+
+            var legend = L.control({position: 'bottomright'});
+            legend.onAdd = function() {
+                this._div = L.DomUtil.create('div', 'info legend');
+                this._div.style.cssText = 'background: white; padding: 6px; font-size: 12px;';
+                this._div.style.display = 'none';
+                return this._div;
+            };
+            legend.show = function(v) {
+                var html = '<b>' + v.label + '</b>';
+                v.labels.forEach(function(label, i) {
+                    html += '<br><i style="background:' + v.colors[i] + ';display:inline-block;width:12px;height:12px;margin-right:4px"></i>' + label;
+                });
+                this._div.innerHTML = html;
+                this._div.style.display = 'block';
+            };
+            legend.addTo(map);
+
+            var overlays = {};
+            overlays[{{ this.boundary_label|tojson }}] = zoomLayer('boundary', {
+                style: {color: '#222222', weight: 2, fill: false},
+                interactive: false
+            }).addTo(map);
+            variables.forEach(function(v, i) {
+                var layer = zoomLayer('grid', {
+                    style: function(f) {
+                        var c = f.properties.c[i];
+                        return {color: '#555555', weight: 0.3,
+                                fillColor: c === null ? '#ffffff' : v.colors[c],
+                                fillOpacity: c === null ? 0 : 0.6};
+                    },
+                    onEachFeature: function(f, l) {
+                        var c = f.properties.c[i];
+                        l.bindTooltip(v.label + ' : ' + (c === null ? '-' : v.labels[c]));
+                    }
+                });
+                layer.on('add', function() { legend.show(v); });
+                overlays[v.label] = layer;
+            });
+            L.control.layers(null, overlays, {collapsed: true}).addTo(map);
+        })();
+        {% endmacro %}
+        """)
+    
+    def __init__(self, meta, labels, url = OVERLAY_URL,
+                 boundary_label = 'Limites du canton'):
+        super().__init__()
+        self._name = 'GridOverlay'
+        self.levels = [{'min_zoom': level['min_zoom'],
+                        'grid': f"{url}/{level['grid']}",
+                        'boundary': f"{url}/{level['boundary']}"}
+                       for level in meta['levels']]
+        self.variables = [dict(variable, label = labels.get(variable['name'],
+                                                            variable['name']))
+                          for variable in meta['variables']]
+        self.boundary_label = boundary_label
+
+#------------------------------------------------------------------------------
+# 4. Command line
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Construit les couches cartographiques (grille et "
+                      "limites du canton) servies à la carte de l'outil web")
+    parser.add_argument('--grid', default = GRID_URL,
+                        help = 'grille des variables territoriales')
+    parser.add_argument('--output-dir', default = OVERLAY_DIR,
+                        help = 'dossier des fichiers statiques')
+    args = parser.parse_args(argv)
+    build_overlays(args.grid, args.output_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed aggregated values of official perimeters (communes, statistical
+sub-sectors, PLQ...), stored in a SQLite table next to the grid and looked
+up by key in the web app:
+
+    python perimeters.py communes=communes.gpkg:NO_COMM:COMMUNE \
+        plq=plq.gpkg:ID_PLQ:NOM_PLQ
+
+The table records the grid's hash and its sources: it is rebuilt from the
+same sources as soon as the grid file changes.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from aggregation import (BUFFER_DISTANCE, GRID_URL, aggregate_polygons,
+                         fetch_grid_store)
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+PERIMETER_TABLE_SUFFIX = '_perimetres.sqlite'
+
+#------------------------------------------------------------------------------
+# 2. Offline build
+def perimeter_table_path(grid_url = GRID_URL):
+    return os.path.splitext(grid_url)[0] + PERIMETER_TABLE_SUFFIX
+
+@contextmanager
+def _connect(table_url):
+    # Committed on success, always closed
+    connection = sqlite3.connect(table_url)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+def _parse_source(spec):
+    # NAME=path/to/layer.gpkg:id_column:name_column
+    name, _, source = spec.partition('=')
+    path, id_column, name_column = (source.rsplit(':', 2) + ['', ''])[:3]
+    if not name or not path or not id_column or not name_column:
+        raise argparse.ArgumentTypeError(
+            f"'{spec}' n'est pas au format NOM=fichier.gpkg:colonne_id:colonne_nom")
+    return {'name': name, 'path': os.path.abspath(path),
+            'id_column': id_column, 'name_column': name_column}
+
+def build_perimeter_table(sources, grid_url = GRID_URL,
+                          buffer_distance = BUFFER_DISTANCE, table_url = None):
+    """
+    Aggregate every perimeter of the sources (dicts with name, path,
+    id_column and name_column) and write the table, keyed by (source,
+    perimeter_id), with the perimeter's name, boundary status, geometry
+    (WKB, grid CRS) and one column per grid variable.
+    """
+    table_url = table_url or perimeter_table_path(grid_url)
+    grid_store = fetch_grid_store(grid_url)
+    crs = grid_store['grid'].crs
+    
+    tables = []
+    for source in sources:
+        polygons = gpd.read_file(source['path']).to_crs(crs)
+        values = aggregate_polygons(polygons, grid_url, buffer_distance)
+        values.insert(0, 'geometry', shapely.to_wkb(polygons.geometry.values))
+        values.insert(0, 'name', polygons[source['name_column']].astype(str))
+        values.insert(0, 'perimeter_id', polygons[source['id_column']].astype(str))
+        values.insert(0, 'source', source['name'])
+        tables.append(values)
+    
+    # Written to a temporary file first, so that readers never see half a table
+    tmp_url = f'{table_url}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_url):
+        os.remove(tmp_url)
+    with _connect(tmp_url) as connection:
+        for values in tables:
+            values.to_sql('perimeters', connection, if_exists = 'append',
+                          index = False)
+        connection.execute('CREATE UNIQUE INDEX perimeters_key '
+                           'ON perimeters (source, perimeter_id)')
+        connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        connection.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('grid_sha1', grid_store['sha1']),
+            ('buffer_distance', json.dumps(buffer_distance)),
+            ('sources', json.dumps(sources))])
+    os.replace(tmp_url, table_url)
+
+#------------------------------------------------------------------------------
+# 3. Lookup
+# Process-wide list of the perimeters of the checked table, per table path
+_tables = {}
+_tables_lock = threading.Lock()
+
+def _table_meta(table_url):
+    with _connect(table_url) as connection:
+        meta = dict(connection.execute('SELECT key, value FROM meta'))
+    return {'grid_sha1': meta['grid_sha1'],
+            'buffer_distance': json.loads(meta['buffer_distance']),
+            'sources': json.loads(meta['sources'])}
+
+def fetch_perimeters(grid_url = GRID_URL):
+    """
+    Perimeters of the table next to the grid (source, perimeter_id, name,
+    boundary_status), None if there is no table. A table built from another
+    version of the grid is first rebuilt from its sources (None if they are
+    missing).
+    """
+    table_url = perimeter_table_path(grid_url)
+    if not os.path.exists(table_url):
+        return None
+    grid_sha1 = fetch_grid_store(grid_url)['sha1']
+    
+    with _tables_lock:
+        stat = os.stat(table_url)
+        key = (stat.st_mtime_ns, stat.st_size, grid_sha1)
+        table = _tables.get(table_url)
+        if table is None or table['key'] != key:
+            meta = _table_meta(table_url)
+            if meta['grid_sha1'] != grid_sha1:
+                if not all(os.path.exists(source['path'])
+                           for source in meta['sources']):
+                    return None
+                build_perimeter_table(meta['sources'], grid_url,
+                                      meta['buffer_distance'], table_url)
+                stat = os.stat(table_url)
+                key = (stat.st_mtime_ns, stat.st_size, grid_sha1)
+            with _connect(table_url) as connection:
+                perimeters = pd.read_sql(
+                    'SELECT source, perimeter_id, name, boundary_status '
+                    'FROM perimeters ORDER BY source, name', connection)
+            table = {'key': key, 'perimeters': perimeters}
+            _tables[table_url] = table
+    return table['perimeters']
+
+def lookup_perimeter(source, perimeter_id, grid_url = GRID_URL):
+    # Row of one perimeter: boundary status, geometry (grid CRS), buffer
+    # distance of the table and the aggregated value of every grid variable;
+    # None if the perimeter is not in the table
+    with _connect(perimeter_table_path(grid_url)) as connection:
+        connection.row_factory = sqlite3.Row
+        row = connection.execute('SELECT * FROM perimeters '
+                                 'WHERE source = ? AND perimeter_id = ?',
+                                 (source, perimeter_id)).fetchone()
+        buffer_distance = connection.execute(
+            "SELECT value FROM meta WHERE key = 'buffer_distance'").fetchone()[0]
+    if row is None:
+        return None
+    row = dict(row)
+    return {'name': row.pop('name'),
+            'boundary_status': row.pop('boundary_status'),
+            'geometry': shapely.from_wkb(row.pop('geometry')),
+            'buffer_distance': json.loads(buffer_distance),
+            'values': {var_name: np.nan if value is None else value
+                       for var_name, value in row.items()
+                       if var_name not in ['source', 'perimeter_id']}}
+
+#------------------------------------------------------------------------------
+# 4. Command line
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = "Précalcule les valeurs agrégées de périmètres officiels "
+                      "(communes, secteurs, PLQ...) pour l'outil web")
+    parser.add_argument('sources', nargs = '+', type = _parse_source,
+                        metavar = 'NOM=fichier.gpkg:colonne_id:colonne_nom',
+                        help = 'couche de périmètres')
+    parser.add_argument('--grid', default = GRID_URL,
+                        help = 'grille des variables territoriales')
+    parser.add_argument('--buffer', type = float, default = BUFFER_DISTANCE,
+                        help = 'rayon du buffer autour des périmètres (m)')
+    args = parser.parse_args(argv)
+    build_perimeter_table(args.sources, args.grid, args.buffer)
+
+if __name__ == '__main__':
+    main()
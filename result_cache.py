@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Thread-safe in-memory cache shared by all sessions of the server process, with
+least-recently-used eviction, a time to live, a memory cap and hit / miss
+counters.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import threading
+import time
+from collections import OrderedDict
+
+#------------------------------------------------------------------------------
+# 1. Cache
+class ResultCache:
+    def __init__(self, max_entries = 1024, max_bytes = None, ttl_seconds = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (value, nbytes, expiry)
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, key, value, nbytes = 0):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            expiry = (time.monotonic() + self.ttl_seconds
+                      if self.ttl_seconds is not None else None)
+            self._entries[key] = (value, nbytes, expiry)
+            self._nbytes += nbytes
+            while (len(self._entries) > self.max_entries
+                   or self.max_bytes is not None and self._nbytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+    
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'bytes': self._nbytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+    
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._nbytes -= nbytes
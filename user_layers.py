@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reading of the geopackages uploaded by the users to replace a grid variable.
+Layers are streamed in batches, keeping only the geometry and the selected
+column of the features near the canton, within a memory budget.
+"""
+#------------------------------------------------------------------------------
+# 0. Import packages
+import os
+import tempfile
+from contextlib import contextmanager
+
+import geopandas as gpd
+import pandas as pd
+import pyogrio
+import shapely
+
+#------------------------------------------------------------------------------
+# 1. Parameters
+READ_BATCH_SIZE = 10000
+# Estimated memory per geometry besides its coordinates (bytes)
+GEOMETRY_OVERHEAD_BYTES = 100
+
+#------------------------------------------------------------------------------
+# 2. Functions
+class MemoryBudgetExceeded(Exception):
+    def __init__(self, nbytes, budget_bytes):
+        super().__init__(f'{nbytes} bytes needed, {budget_bytes} bytes available')
+        self.nbytes = nbytes
+        self.budget_bytes = budget_bytes
+
+@contextmanager
+def _as_path(source):
+    # Streamlit's UploadedFile (or any file-like object) is spilled once to a
+    # temporary file, so that it can be read in batches without new copies
+    if not hasattr(source, 'getvalue'):
+        yield source
+        return
+    
+    f = tempfile.NamedTemporaryFile(suffix = '.gpkg', delete = False)
+    try:
+        with f:
+            f.write(source.getvalue())
+        yield f.name
+    finally:
+        os.remove(f.name)
+
+def layer_nbytes(layer):
+    # Estimated memory used by a GeoDataFrame
+    attributes = layer.drop(columns = layer.geometry.name).memory_usage(deep = True).sum()
+    coordinates = 16 * shapely.get_num_coordinates(layer.geometry.values).sum()
+    return int(attributes + coordinates + GEOMETRY_OVERHEAD_BYTES * len(layer))
+
+def read_layer_info(source):
+    # Column names, CRS and number of features, without reading the features
+    with _as_path(source) as path:
+        info = pyogrio.read_info(path)
+    return {'columns': list(info['fields']),
+            'crs': info['crs'],
+            'features': info['features']}
+
+def read_layer_column(source, column, extent, extent_crs,
+                      budget_bytes = None, batch_size = READ_BATCH_SIZE):
+    """
+    Stream the features of the layer intersecting extent (xmin, ymin, xmax,
+    ymax in extent_crs), keeping only the geometry and column, clipped to the
+    extent. Raises MemoryBudgetExceeded as soon as the kept features need more
+    than budget_bytes.
+    """
+    batches = []
+    nbytes = 0
+    with _as_path(source) as path:
+        layer_crs = pyogrio.read_info(path)['crs'] or extent_crs
+        bbox = tuple(gpd.GeoSeries([shapely.box(*extent)], crs = extent_crs)
+                     .to_crs(layer_crs).total_bounds)
+        
+        # Arrow record batches of one pass over the layer (paging with
+        # skip_features would re-scan the previous features for every batch)
+        with pyogrio.open_arrow(path, columns = [column], bbox = bbox,
+                                batch_size = batch_size,
+                                use_pyarrow = True) as (meta, reader):
+            geometry_name = meta['geometry_name'] or 'wkb_geometry'
+            for record_batch in reader:
+                geoms = shapely.from_wkb(
+                    record_batch.column(geometry_name).to_numpy(zero_copy_only = False))
+                batch = gpd.GeoDataFrame(
+                    record_batch.drop_columns([geometry_name]).to_pandas(),
+                    geometry = shapely.clip_by_rect(geoms, *bbox), crs = layer_crs)
+                batch = batch[~batch.geometry.is_empty]
+                nbytes += layer_nbytes(batch)
+                if budget_bytes is not None and nbytes > budget_bytes:
+                    raise MemoryBudgetExceeded(nbytes, budget_bytes)
+                batches.append(batch)
+    
+    if not batches:
+        return gpd.GeoDataFrame({column: []}, geometry = [], crs = layer_crs)
+    return gpd.GeoDataFrame(pd.concat(batches, ignore_index = True),
+                            crs = layer_crs)